@@ -78,9 +78,33 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Download jobs are written by background threads in every worker process.
+        # WAL lets status polls read while a job writes, IMMEDIATE avoids lock upgrade failures.
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    }
+}
+
+
+# Cache
+# File based so resolution results are shared between worker processes and
+# with management commands such as warm_cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('VSCODE_DOWNLOADER_CACHE_DIR', BASE_DIR / 'vscode_downloader' / 'tmp' / 'cache'),
     }
 }
 
+# How long a resolved compatible version is reused (seconds)
+VSCODE_DOWNLOADER_RESOLUTION_TTL = int(os.environ.get('VSCODE_DOWNLOADER_RESOLUTION_TTL', 6 * 3600))
+# How long a page of the catalog listing is reused (seconds)
+VSCODE_DOWNLOADER_LISTING_TTL = int(os.environ.get('VSCODE_DOWNLOADER_LISTING_TTL', 300))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -130,3 +154,40 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Serving of cached VSIX files and finished bundles
+# '' streams through Django with FileResponse (sendfile via wsgi.file_wrapper),
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd) hand the transfer to the front proxy
+VSCODE_DOWNLOADER_SENDFILE_MODE = os.environ.get('VSCODE_DOWNLOADER_SENDFILE_MODE', '')
+# Internal nginx location that aliases vscode_downloader/tmp/, used with x-accel-redirect
+VSCODE_DOWNLOADER_ACCEL_PREFIX = os.environ.get('VSCODE_DOWNLOADER_ACCEL_PREFIX', '/protected-downloads/')
+
+# Upstream marketplace traffic. Retry-After pauses and limit decreases are shared by all worker
+# processes through CACHES['default'] (use a shared backend such as Redis across hosts), the
+# token bucket and concurrency limit below apply to each worker process
+# Requests per second and burst size of the token bucket
+VSCODE_DOWNLOADER_UPSTREAM_RATE = float(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_RATE', 10))
+VSCODE_DOWNLOADER_UPSTREAM_BURST = int(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_BURST', 20))
+# Upper bound for the adaptive number of concurrent upstream requests
+VSCODE_DOWNLOADER_UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_MAX_CONCURRENCY', 16))
+# Pooled HTTP client: number of hosts to keep pools for, and kept-alive connections per host
+VSCODE_DOWNLOADER_UPSTREAM_POOL_HOSTS = int(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_POOL_HOSTS', 16))
+VSCODE_DOWNLOADER_UPSTREAM_POOL_SIZE = int(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_POOL_SIZE', VSCODE_DOWNLOADER_UPSTREAM_MAX_CONCURRENCY))
+# Seconds to establish a connection, and between bytes of a response
+VSCODE_DOWNLOADER_UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_CONNECT_TIMEOUT', 10))
+VSCODE_DOWNLOADER_UPSTREAM_READ_TIMEOUT = float(os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_READ_TIMEOUT', 60))
+# Proxy for all marketplace traffic, e.g. http://proxy.example.com:3128 (HTTP(S)_PROXY is honoured otherwise)
+VSCODE_DOWNLOADER_UPSTREAM_PROXY = os.environ.get('VSCODE_DOWNLOADER_UPSTREAM_PROXY', '')
+
+# Resume bulk downloads that were interrupted by a restart or a crashed worker
+VSCODE_DOWNLOADER_RESUME_JOBS = os.environ.get('VSCODE_DOWNLOADER_RESUME_JOBS', 'True') == 'True'
+# Bulk jobs whose status nobody polled for this many seconds are cancelled. Browsers throttle
+# timers in background tabs to about once a minute, and it has to exceed the resume lease
+# (checked on startup), so keep this at several minutes
+VSCODE_DOWNLOADER_ABANDON_TIMEOUT = int(os.environ.get('VSCODE_DOWNLOADER_ABANDON_TIMEOUT', 600))
+
+# Profile every download job: '' (off, jobs can still opt in with "profile"), 'spans' or 'sample'
+# Traces are served by api/download-trace/<download_id>/
+VSCODE_DOWNLOADER_PROFILE = os.environ.get('VSCODE_DOWNLOADER_PROFILE', '')
+# Seconds between stack samples in 'sample' mode
+VSCODE_DOWNLOADER_PROFILE_SAMPLE_INTERVAL = float(os.environ.get('VSCODE_DOWNLOADER_PROFILE_SAMPLE_INTERVAL', 0.005))
@@ -1,6 +1,23 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.core import checks
 
 
 class VscodeDownloaderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vscode_downloader'
+
+    def ready(self):
+        from .checks import check_abandon_timeout
+        checks.register(check_abandon_timeout)
+
+        # Resume bulk jobs interrupted by a restart, but only in processes that serve requests
+        argv = sys.argv
+        serving = os.path.basename(argv[0]).startswith('gunicorn') or (
+            'runserver' in argv and (os.environ.get('RUN_MAIN') == 'true' or '--noreload' in argv)
+        )
+        if serving:
+            from .views import start_job_supervisor
+            start_job_supervisor()
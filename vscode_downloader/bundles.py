@@ -0,0 +1,177 @@
+"""
+Writing bundles of downloaded VSIX files.
+
+A bundle is either a single ZIP or, for size limited transfer media, a set of
+independent ZIP volumes of at most ``volume_size`` bytes each, listed in an
+index with their sha256 checksums. Used by bulk jobs and the
+bundle_extensions command.
+"""
+import hashlib
+import json
+import os
+import zipfile
+
+
+def file_sha256(path):
+    """Hex sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_size(value):
+    """Parse a byte count such as 4294967296, '700M' or '4G'"""
+    if value in (None, ''):
+        return None
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class HashingWriter:
+    """
+    Append-only file wrapper that hashes everything written through it.
+    It refuses to seek, which makes ZipFile write data descriptors instead of
+    patching headers afterwards, so the hash is computed in the same pass.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def seek(self, *args):
+        raise OSError('HashingWriter is not seekable')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BundleWriter:
+    """
+    Write bundle entries either into a single ZIP at ``path`` or, with a
+    ``volume_size``, into independent ZIP volumes ``<stem>.001.zip``,
+    ``<stem>.002.zip``... of at most that many bytes each, plus an
+    ``<stem>.index.json`` and ``<stem>.sha256`` checksum index.
+
+    Volumes store entries without recompression (VSIX files are already
+    compressed), so their size is known before an entry is added. An entry
+    larger than ``volume_size`` gets a volume of its own and exceeds the limit.
+    """
+    def __init__(self, path, volume_size=None):
+        self.path = path
+        self.volume_size = volume_size
+        self.stem = path[:-len('.zip')] if path.endswith('.zip') else path
+        self.volumes = []
+        self.writer = None
+        self.zip_file = None
+        self.entries = []
+        self.directory_size = 0
+        if not volume_size:
+            self.zip_file = zipfile.ZipFile(f'{path}.part', 'w', zipfile.ZIP_DEFLATED)
+
+    def record_sizes(self, offset, name_length, size):
+        """
+        Bytes ZipFile writes for a stored entry at ``offset``: its local header,
+        data and data descriptor, and its central directory record. Mirrors
+        ZipFile's own zip64 decisions, which depend on the size and offset.
+        """
+        # ZipFile switches the local header (and data descriptor) to zip64 early, in case compression grows the data
+        local_zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+        local = 30 + name_length + (20 if local_zip64 else 0) + size + (24 if local_zip64 else 16)
+        central_extra = 0
+        if size > zipfile.ZIP64_LIMIT:
+            central_extra += 16
+        if offset > zipfile.ZIP64_LIMIT:
+            central_extra += 8
+        central = 46 + name_length + (4 + central_extra if central_extra else 0)
+        return local, central
+
+    def end_size(self, directory_offset, directory_size, count):
+        """End of central directory record, preceded by the zip64 record and locator when needed"""
+        if (count > zipfile.ZIP_FILECOUNT_LIMIT or directory_offset > zipfile.ZIP64_LIMIT
+                or directory_size > zipfile.ZIP64_LIMIT):
+            return 56 + 20 + 22
+        return 22
+
+    def add(self, path, arcname):
+        if self.volume_size:
+            encoded_name_length = len(arcname.encode('utf-8'))
+            size = os.path.getsize(path)
+            if self.zip_file is not None and self.entries:
+                offset = self.writer.tell()
+                local, central = self.record_sizes(offset, encoded_name_length, size)
+                directory_size = self.directory_size + central
+                end = self.end_size(offset + local, directory_size, len(self.entries) + 1)
+                if offset + local + directory_size + end > self.volume_size:
+                    self.close_volume()
+            if self.zip_file is None:
+                self.open_volume()
+            self.directory_size += self.record_sizes(self.writer.tell(), encoded_name_length, size)[1]
+        self.zip_file.write(path, arcname=arcname)
+        self.entries.append(arcname)
+
+    def open_volume(self):
+        volume_path = f'{self.stem}.{len(self.volumes) + 1:03d}.zip'
+        self.writer = HashingWriter(f'{volume_path}.part')
+        self.zip_file = zipfile.ZipFile(self.writer, 'w', zipfile.ZIP_STORED)
+        self.volumes.append({'name': os.path.basename(volume_path), 'path': volume_path})
+        self.entries = []
+        self.directory_size = 0
+
+    def close_volume(self):
+        self.zip_file.close()
+        self.writer.close()
+        volume = self.volumes[-1]
+        volume.update(size=self.writer.size, sha256=self.writer.sha256.hexdigest(), entries=self.entries)
+        os.replace(f"{volume['path']}.part", volume['path'])
+        self.zip_file = None
+
+    def abort(self):
+        """Stop writing and remove everything written so far"""
+        if self.zip_file is not None:
+            self.zip_file.close()
+        if self.writer is not None:
+            self.writer.close()
+        paths = [f'{self.path}.part'] + [volume['path'] for volume in self.volumes]
+        paths += [f"{volume['path']}.part" for volume in self.volumes]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.zip_file = None
+
+    def close(self):
+        """Finish the bundle and return the list of files written"""
+        if not self.volume_size:
+            self.zip_file.close()
+            os.replace(f'{self.path}.part', self.path)
+            return [self.path]
+
+        if self.zip_file is None:
+            self.open_volume()
+        self.close_volume()
+        index = [{key: value for key, value in volume.items() if key != 'path'} for volume in self.volumes]
+        with open(f'{self.stem}.index.json', 'w', encoding='utf-8') as f:
+            json.dump({'volume_size': self.volume_size, 'volumes': index}, f, indent=2)
+        # Same format as sha256sum, so `sha256sum -c` verifies the volumes on the other side
+        with open(f'{self.stem}.sha256', 'w', encoding='utf-8') as f:
+            for volume in index:
+                f.write(f"{volume['sha256']}  {volume['name']}\n")
+        return [volume['path'] for volume in self.volumes] + [f'{self.stem}.index.json', f'{self.stem}.sha256']
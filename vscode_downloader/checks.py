@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.checks import Error
+
+
+def check_abandon_timeout(app_configs, **kwargs):
+    from .views import JOB_LEASE
+
+    # A resumed job is only picked up JOB_LEASE (plus one supervisor interval) after
+    # its last heartbeat, it must not count as abandoned by then
+    minimum = JOB_LEASE + JOB_LEASE / 2
+    if settings.VSCODE_DOWNLOADER_ABANDON_TIMEOUT <= minimum:
+        return [Error(
+            f'VSCODE_DOWNLOADER_ABANDON_TIMEOUT must be longer than {minimum:g} seconds',
+            hint='Resumed jobs would be cancelled as abandoned at their first check.',
+            id='vscode_downloader.E001',
+        )]
+    return []
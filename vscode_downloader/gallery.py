@@ -0,0 +1,302 @@
+"""
+Local extension gallery.
+
+VS Code can use this instance as its extension marketplace by pointing
+product.json's extensionsGallery.serviceUrl at /vscode_downloader/gallery.
+Everything is answered from an index of the VSIX files in the temp directory
+that is only rebuilt when VSIX files are added, replaced or removed.
+"""
+import json
+import mimetypes
+import os
+import threading
+import uuid
+import zipfile
+from datetime import datetime, timezone as dt_timezone
+
+import semver
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from .views import compressed_json_response, get_tmp_dir, get_vsix_metadata, serve_file
+
+GALLERY_ASSET_MEMBERS = {
+    'Microsoft.VisualStudio.Code.Manifest': 'extension/package.json',
+    'Microsoft.VisualStudio.Services.Content.Details': 'extension/readme.md',
+    'Microsoft.VisualStudio.Services.Content.Changelog': 'extension/changelog.md',
+    'Microsoft.VisualStudio.Services.Content.License': 'extension/license',
+    'Microsoft.VisualStudio.Services.VsixManifest': 'extension.vsixmanifest',
+}
+
+_gallery_index = {'signature': None}
+_gallery_index_lock = threading.Lock()
+
+
+def version_sort_key(version):
+    try:
+        return (1, semver.Version.parse(version))
+    except (ValueError, TypeError):
+        return (0, str(version))
+
+
+def build_gallery_index():
+    """Scan the cached VSIX files into a list of marketplace style extension records"""
+    tmp_dir = get_tmp_dir()
+    extensions = {}
+    for name in os.listdir(tmp_dir):
+        if not name.endswith('.vsix'):
+            continue
+        path = os.path.join(tmp_dir, name)
+        try:
+            metadata = get_vsix_metadata(path)
+        except (zipfile.BadZipFile, KeyError, json.JSONDecodeError, OSError):
+            continue
+        manifest = metadata['manifest']
+        if not manifest.get('publisher') or not manifest.get('name') or not manifest.get('version'):
+            continue
+        extension_id = f"{manifest['publisher']}.{manifest['name']}".lower()
+        # The cache name is not reliable here, universal packages are also cached under platform names
+        target_platform = metadata.get('target_platform')
+
+        record = extensions.setdefault(extension_id, {'manifest': manifest, 'versions': {}})
+        # Universal packages cached under several platform names are the same version
+        record['versions'].setdefault((manifest['version'], target_platform), {
+            'version': manifest['version'],
+            'targetPlatform': target_platform,
+            'file': name,
+            'manifest': manifest,
+            'properties': metadata.get('properties', {}),
+            'lastUpdated': datetime.fromtimestamp(os.path.getmtime(path), dt_timezone.utc).isoformat(),
+        })
+
+    index = []
+    for extension_id, record in sorted(extensions.items()):
+        versions = sorted(record['versions'].values(), key=lambda v: version_sort_key(v['version']), reverse=True)
+        manifest = versions[0]['manifest']
+        index.append({
+            'id': extension_id,
+            'manifest': manifest,
+            'versions': versions,
+            'search_text': ' '.join([
+                extension_id,
+                manifest.get('displayName', ''),
+                manifest.get('description', ''),
+                ' '.join(manifest.get('keywords', []) or []),
+            ]).lower(),
+        })
+    return index
+
+
+def gallery_signature():
+    """
+    The cached VSIX files with their modification times. Unlike the directory's
+    mtime this ignores partial downloads and metadata sidecars, which change
+    constantly while downloads are running.
+    """
+    with os.scandir(get_tmp_dir()) as entries:
+        return frozenset(
+            (entry.name, entry.stat().st_mtime_ns)
+            for entry in entries if entry.name.endswith('.vsix') and entry.is_file()
+        )
+
+
+def get_gallery_index():
+    """The gallery index, rebuilt only when VSIX files were added, replaced or removed"""
+    signature = gallery_signature()
+    if _gallery_index['signature'] != signature:
+        with _gallery_index_lock:
+            if _gallery_index['signature'] != signature:
+                index = build_gallery_index()
+                _gallery_index.update(
+                    signature=signature,
+                    extensions=index,
+                    by_id={extension['id']: extension for extension in index},
+                    by_uuid={gallery_uuid(extension['id']): extension for extension in index},
+                    rendered={},
+                )
+    return _gallery_index
+
+
+def gallery_uuid(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'vscode-downloader:{name}'))
+
+
+def render_gallery_extension(extension, base_url, latest_only=False):
+    manifest = extension['manifest']
+    publisher, name = manifest['publisher'], manifest['name']
+    versions = []
+    seen_platforms = set()
+    for version in extension['versions']:
+        if latest_only:
+            if version['targetPlatform'] in seen_platforms:
+                continue
+            seen_platforms.add(version['targetPlatform'])
+        asset_uri = f"{base_url}/assets/{publisher}/{name}/{version['version']}"
+        query = f"?targetPlatform={version['targetPlatform']}" if version['targetPlatform'] else ''
+        version_manifest = version['manifest']
+        properties = [
+            {'key': 'Microsoft.VisualStudio.Code.Engine', 'value': version_manifest.get('engines', {}).get('vscode', '*')},
+            {'key': 'Microsoft.VisualStudio.Code.ExtensionDependencies',
+             'value': ','.join(version_manifest.get('extensionDependencies', []))},
+            {'key': 'Microsoft.VisualStudio.Code.ExtensionPack', 'value': ','.join(version_manifest.get('extensionPack', []))},
+            {'key': 'Microsoft.VisualStudio.Code.ExtensionKind', 'value': ','.join(version_manifest.get('extensionKind', []))},
+        ]
+        if version['properties'].get('Microsoft.VisualStudio.Code.PreRelease'):
+            properties.append({'key': 'Microsoft.VisualStudio.Code.PreRelease', 'value': 'true'})
+        files = [{'assetType': 'Microsoft.VisualStudio.Services.VSIXPackage',
+                  'source': f'{asset_uri}/Microsoft.VisualStudio.Services.VSIXPackage{query}'}]
+        files += [{'assetType': asset_type, 'source': f'{asset_uri}/{asset_type}{query}'} for asset_type in GALLERY_ASSET_MEMBERS]
+        if version_manifest.get('icon'):
+            files.append({'assetType': 'Microsoft.VisualStudio.Services.Icons.Default',
+                          'source': f'{asset_uri}/Microsoft.VisualStudio.Services.Icons.Default{query}'})
+        rendered_version = {
+            'version': version['version'],
+            'lastUpdated': version['lastUpdated'],
+            'assetUri': asset_uri,
+            'fallbackAssetUri': asset_uri,
+            'files': files,
+            'properties': properties,
+        }
+        if version['targetPlatform']:
+            rendered_version['targetPlatform'] = version['targetPlatform']
+        versions.append(rendered_version)
+
+    return {
+        'extensionId': gallery_uuid(extension['id']),
+        'extensionName': name,
+        'displayName': manifest.get('displayName', name),
+        'shortDescription': manifest.get('description', ''),
+        'flags': 'validated, public',
+        'lastUpdated': extension['versions'][0]['lastUpdated'],
+        'publisher': {
+            'publisherId': gallery_uuid(publisher.lower()),
+            'publisherName': publisher,
+            'displayName': publisher,
+        },
+        'versions': versions,
+        'categories': manifest.get('categories', []),
+        'tags': manifest.get('keywords', []),
+        'statistics': [],
+    }
+
+
+def query_gallery(index, criteria):
+    """Apply marketplace filter criteria to the index"""
+    extensions = index['extensions']
+    names = [c['value'].lower() for c in criteria if c.get('filterType') == 7 and c.get('value')]
+    uuids = [c['value'] for c in criteria if c.get('filterType') == 4 and c.get('value')]
+    search = [c['value'].lower() for c in criteria if c.get('filterType') == 10 and c.get('value')]
+
+    if names or uuids:
+        extensions = [index['by_id'][name] for name in names if name in index['by_id']]
+        extensions += [index['by_uuid'][value] for value in uuids if value in index['by_uuid']]
+    for text in search:
+        words = text.split()
+        extensions = [extension for extension in extensions if all(word in extension['search_text'] for word in words)]
+    return extensions
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def gallery_extension_query(request):
+    """Marketplace compatible extensionquery endpoint backed by the local VSIX store"""
+    try:
+        body = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    index = get_gallery_index()
+    base_url = request.build_absolute_uri(reverse('vscode_downloader:gallery_root')).rstrip('/')
+    latest_only = bool(body.get('flags', 0) & 0x200)
+    # Rendering is cached per base URL and index generation, queries only slice it
+    rendered = index['rendered'].setdefault((base_url, latest_only), {})
+
+    results = []
+    for query_filter in body.get('filters', []) or [{}]:
+        matches = query_gallery(index, query_filter.get('criteria', []))
+        try:
+            page_size = max(int(query_filter.get('pageSize') or 50), 1)
+            page_number = max(int(query_filter.get('pageNumber') or 1), 1)
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'Invalid pageSize or pageNumber'}, status=400)
+        page = matches[(page_number - 1) * page_size:page_number * page_size]
+        extensions = []
+        for extension in page:
+            if extension['id'] not in rendered:
+                rendered[extension['id']] = render_gallery_extension(extension, base_url, latest_only)
+            extensions.append(rendered[extension['id']])
+        results.append({
+            'extensions': extensions,
+            'pagingToken': None,
+            'resultMetadata': [{
+                'metadataType': 'ResultCount',
+                'metadataItems': [{'name': 'TotalCount', 'count': len(matches)}],
+            }],
+        })
+    return compressed_json_response(request, {'results': results})
+
+
+def find_gallery_version(publisher, name, version, target_platform):
+    extension = get_gallery_index()['by_id'].get(f'{publisher}.{name}'.lower())
+    if not extension:
+        return None
+    candidates = [v for v in extension['versions'] if v['version'] == version]
+    for candidate in candidates:
+        if candidate['targetPlatform'] == target_platform:
+            return candidate
+    for candidate in candidates:
+        if candidate['targetPlatform'] is None:
+            return candidate
+    return candidates[0] if candidates and not target_platform else None
+
+
+def gallery_asset(request, publisher, name, version, asset_type):
+    """Serve a VSIX or a single file from inside it for the local gallery"""
+    gallery_version = find_gallery_version(publisher, name, version, request.GET.get('targetPlatform'))
+    if not gallery_version:
+        return JsonResponse({'error': 'Extension version not found'}, status=404)
+
+    path = os.path.join(get_tmp_dir(), gallery_version['file'])
+    if asset_type == 'Microsoft.VisualStudio.Services.VSIXPackage':
+        return serve_file(path, f'{publisher}.{name}-{version}.vsix')
+
+    if asset_type == 'Microsoft.VisualStudio.Services.Icons.Default' and gallery_version['manifest'].get('icon'):
+        member = 'extension/' + gallery_version['manifest']['icon'].lstrip('./')
+    elif asset_type in GALLERY_ASSET_MEMBERS:
+        member = GALLERY_ASSET_MEMBERS[asset_type]
+    else:
+        return JsonResponse({'error': f'Unknown asset type: {asset_type}'}, status=404)
+
+    with zipfile.ZipFile(path) as vsix_file:
+        # File names inside VSIX packages differ in case between publishers
+        names = {info.filename.lower(): info.filename for info in vsix_file.infolist()}
+        member_name = names.get(member.lower()) or next(
+            (names[key] for key in names if key.startswith(member.lower() + '.')), None)
+        if not member_name:
+            return JsonResponse({'error': f'{asset_type} not found'}, status=404)
+        content = vsix_file.read(member_name)
+
+    content_type = mimetypes.guess_type(member_name)[0] or 'text/plain'
+    response = HttpResponse(content, content_type=content_type)
+    response['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+
+def gallery_vspackage(request, publisher, name, version):
+    return gallery_asset(request, publisher, name, version, 'Microsoft.VisualStudio.Services.VSIXPackage')
+
+
+def gallery_latest(request, publisher, name):
+    """Latest version record of one extension, as served by the marketplace's /vscode/ endpoint"""
+    extension = get_gallery_index()['by_id'].get(f'{publisher}.{name}'.lower())
+    if not extension:
+        return JsonResponse({'error': 'Extension not found'}, status=404)
+    base_url = request.build_absolute_uri(reverse('vscode_downloader:gallery_root')).rstrip('/')
+    return compressed_json_response(request, render_gallery_extension(extension, base_url, latest_only=True))
+
+
+def gallery_root(request):
+    index = get_gallery_index()
+    return JsonResponse({'extensions': len(index['extensions'])})
@@ -0,0 +1,243 @@
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vscode_downloader.bundles import BundleWriter, file_sha256, parse_size
+from vscode_downloader.models import VsixPackage
+from vscode_downloader.views import download_vsix, get_tmp_dir, resolve_extension_platforms, resolve_pinned_version
+
+
+def strip_json_comments(text):
+    """Turn VS Code's JSON with comments (and trailing commas) into plain JSON"""
+    pattern = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+    text = pattern.sub(lambda m: m.group(1) or '', text)
+    return re.sub(r',(\s*[\]}])', r'\1', text)
+
+
+def read_extension_list(path):
+    """
+    Read extension ids from either a .vscode/extensions.json style file or a
+    plain text file with one ``publisher.extension[@version]`` per line.
+    Returns a list of (extension_id, version or None).
+    """
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+
+    if path.endswith('.json') or content.lstrip().startswith(('{', '[')):
+        data = json.loads(strip_json_comments(content))
+        items = data.get('recommendations', []) if isinstance(data, dict) else data
+    else:
+        items = [line.split('#', 1)[0].strip() for line in content.splitlines()]
+
+    extensions = []
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get('id') or f"{item['publisher']}.{item['extension']}"
+        if not item:
+            continue
+        extension_id, _, version = item.partition('@')
+        if '.' not in extension_id:
+            raise CommandError(f'Invalid extension id: {extension_id}')
+        extensions.append((extension_id, version or None))
+    return extensions
+
+
+def fetch_verified(vsix, tmp_dir, sha256=None):
+    """Download a VSIX and, when a hash is pinned, make sure the file matches it"""
+    path, cached = download_vsix(vsix, tmp_dir)
+    if sha256 and file_sha256(path) != sha256:
+        # A stale or corrupt cache entry gets one fresh download before giving up
+        os.remove(path)
+        path, cached = download_vsix(vsix, tmp_dir)
+        if file_sha256(path) != sha256:
+            os.remove(path)
+            raise CommandError(f'sha256 mismatch for {vsix.get_vsix_name()}')
+    return path, cached
+
+
+def write_lockfile(path, vscode_version, platforms, entries, paths):
+    """Record one entry per artifact with the platforms it is bundled for"""
+    artifacts = {}
+    for platform, vsix in entries:
+        name = vsix.get_cache_name()
+        if name not in paths:
+            continue
+        if name not in artifacts:
+            artifacts[name] = {
+                'id': f'{vsix.publisher}.{vsix.extension}',
+                'version': vsix.version,
+                'targetPlatform': vsix.target,
+                'platforms': [],
+                'url': vsix.get_url(),
+                'size': os.path.getsize(paths[name]),
+                'sha256': file_sha256(paths[name]),
+            }
+        artifacts[name]['platforms'].append(platform)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'lockfileVersion': 1,
+            'vscodeVersion': vscode_version,
+            'platforms': platforms,
+            'extensions': list(artifacts.values()),
+        }, f, indent=2)
+        f.write('\n')
+
+
+def read_lockfile(path):
+    with open(path, encoding='utf-8') as f:
+        lock = json.load(f)
+    if lock.get('lockfileVersion') != 1:
+        raise CommandError(f'Unsupported lockfile version: {lock.get("lockfileVersion")}')
+    for entry in lock['extensions']:
+        publisher, extension = entry['id'].split('.', 1)
+        entry['cache_name'] = VsixPackage(publisher, extension, entry['version'], entry.get('targetPlatform')).get_cache_name()
+    return lock
+
+
+def lock_entries(lock):
+    entries = []
+    for entry in lock['extensions']:
+        publisher, extension = entry['id'].split('.', 1)
+        for platform in entry['platforms']:
+            entries.append((platform, VsixPackage(
+                publisher=publisher,
+                extension=extension,
+                version=entry['version'],
+                target=entry.get('targetPlatform')
+            )))
+    return entries
+
+
+class Command(BaseCommand):
+    help = ('Resolve, download and bundle a list of extensions into a ZIP file without the web server. '
+            'Use --write-lock to pin the result and --lock to rebuild it without any marketplace queries.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('extensions_file', nargs='?',
+                            help='extensions.json recommendations file or text file with one id per line')
+        parser.add_argument('--vscode-version', help='Target VS Code version, e.g. 1.95.0')
+        parser.add_argument('--platform', dest='platforms', action='append',
+                            help='Target platform (repeatable), defaults to win32-x64')
+        parser.add_argument('--output', '-o', default='vscode_extensions.zip', help='Path of the ZIP file to write')
+        parser.add_argument('--layout', choices=['folders', 'archives'], default='folders',
+                            help='With several platforms: one folder per platform, or one archive per platform')
+        parser.add_argument('--volume-size', type=parse_size,
+                            help='Split the output into independent ZIP volumes of at most this size, e.g. 700M or 4G')
+        parser.add_argument('--workers', type=int, default=8, help='Number of parallel resolve/download workers')
+        parser.add_argument('--write-lock', help='Write the resolved versions, URLs, sizes and hashes to this lockfile '
+                                               '(skipped when any extension fails)')
+        parser.add_argument('--lock', help='Build from a lockfile instead of resolving, verifying every hash')
+
+    def handle(self, *args, **options):
+        failures = []
+        if options['lock']:
+            lock = read_lockfile(options['lock'])
+            platforms = lock['platforms']
+            entries = lock_entries(lock)
+            expected = {entry['cache_name']: entry for entry in lock['extensions']}
+        else:
+            if not options['extensions_file'] or not options['vscode_version']:
+                raise CommandError('extensions_file and --vscode-version are required unless --lock is given')
+            platforms = options['platforms'] or ['win32-x64']
+            entries = self.resolve(options, platforms, failures)
+            expected = {}
+
+        # Universal packages are shared between platforms and only downloaded once
+        artifacts = {}
+        for _, vsix in entries:
+            artifacts.setdefault(vsix.get_cache_name(), vsix)
+
+        tmp_dir = get_tmp_dir()
+        paths = {}
+        self.stdout.write(f'Downloading {len(artifacts)} packages')
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                name: executor.submit(fetch_verified, vsix, tmp_dir, expected.get(name, {}).get('sha256'))
+                for name, vsix in artifacts.items()
+            }
+            for name, future in futures.items():
+                try:
+                    paths[name], cached = future.result()
+                    self.stdout.write(f"{'cached' if cached else 'downloaded'} {artifacts[name].get_vsix_name()}")
+                except Exception as e:
+                    failures.append(f'Failed to download {artifacts[name].get_vsix_name()}: {e}')
+
+        if options['write_lock'] and failures:
+            # A lockfile without the failed extensions would later build an incomplete bundle without complaint
+            self.stderr.write(f"Not writing lockfile {options['write_lock']} because some extensions failed")
+        elif options['write_lock']:
+            write_lockfile(options['write_lock'], options['vscode_version'], platforms, entries, paths)
+            self.stdout.write(f"Wrote lockfile {options['write_lock']}")
+
+        for path in self.write_archives(options['output'], entries, paths, platforms, options['layout'],
+                                        options['volume_size']):
+            self.stdout.write(self.style.SUCCESS(f'Wrote {path}'))
+
+        if failures:
+            for failure in failures:
+                self.stderr.write(failure)
+            raise CommandError(f'{len(failures)} extension(s) could not be bundled')
+
+    def resolve(self, options, platforms, failures):
+        vscode_version = options['vscode_version']
+        extensions = read_extension_list(options['extensions_file'])
+        if not extensions:
+            raise CommandError('No extensions found in the list')
+
+        def resolve(item):
+            extension_id, version = item
+            if version:
+                # Pinned versions still need the marketplace to tell platform packages from universal ones
+                return item, resolve_pinned_version(extension_id, version, platforms)
+            return item, resolve_extension_platforms(extension_id, vscode_version, platforms)
+
+        entries = []
+        self.stdout.write(f'Resolving {len(extensions)} extensions for {", ".join(platforms)}')
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for future in [executor.submit(resolve, item) for item in extensions]:
+                try:
+                    (extension_id, version), resolved = future.result()
+                except Exception as e:
+                    failures.append(f'Failed to resolve: {e}')
+                    continue
+                publisher, extension = extension_id.split('.', 1)
+                for platform in platforms:
+                    result = resolved.get(platform)
+                    if not result and version:
+                        failures.append(f'{extension_id}@{version} is not published for {platform}')
+                        continue
+                    if not result:
+                        failures.append(f'No compatible version of {extension_id} for {platform}')
+                        continue
+                    entries.append((platform, VsixPackage(
+                        publisher=publisher,
+                        extension=extension,
+                        version=result['version'],
+                        target=result.get('targetPlatform')
+                    )))
+        return entries
+
+    def write_archives(self, output, entries, paths, platforms, layout, volume_size=None):
+        if len(platforms) > 1 and layout == 'archives':
+            root, ext = os.path.splitext(output)
+            archives = {f'{root}-{platform}{ext or ".zip"}': [
+                (vsix, vsix.get_vsix_name()) for entry_platform, vsix in entries if entry_platform == platform
+            ] for platform in platforms}
+        else:
+            archives = {output: [
+                (vsix, f'{platform}/{vsix.get_vsix_name()}' if len(platforms) > 1 else vsix.get_vsix_name())
+                for platform, vsix in entries
+            ]}
+
+        written = []
+        for path, archive_entries in archives.items():
+            bundle = BundleWriter(path, volume_size)
+            for vsix, arcname in archive_entries:
+                if vsix.get_cache_name() in paths:
+                    bundle.add(paths[vsix.get_cache_name()], arcname)
+            written.extend(bundle.close())
+        return written
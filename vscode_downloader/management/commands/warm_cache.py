@@ -0,0 +1,121 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vscode_downloader.models import VsixPackage
+from vscode_downloader.views import (
+    cache_compatible_version,
+    download_vsix,
+    find_compatible_version,
+    get_tmp_dir,
+    get_vscode_extensions,
+    mark_universal,
+)
+
+
+class Command(BaseCommand):
+    help = ('Pre-resolve compatible versions and pre-fetch VSIX files for a policy of extensions, '
+            'VS Code versions and platforms, so on-demand requests are served from the cache. '
+            'Meant to run from cron during off-hours.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('policy', help='JSON file with "extensions", "vscodeVersions" and "platforms" lists')
+        parser.add_argument('--concurrency', type=int, default=4, help='Maximum parallel marketplace requests')
+        parser.add_argument('--report', help='Also write the warm-up report as JSON to this file')
+        parser.add_argument('--resolve-only', action='store_true', help='Only pre-resolve versions, do not fetch VSIX files')
+
+    def handle(self, *args, **options):
+        with open(options['policy'], encoding='utf-8') as f:
+            policy = json.load(f)
+        extensions = policy.get('extensions', [])
+        vscode_versions = policy.get('vscodeVersions', [])
+        platforms = policy.get('platforms') or ['win32-x64']
+        if not extensions or not vscode_versions:
+            raise CommandError('The policy needs at least one extension and one VS Code version')
+
+        report = []
+        artifacts = {}
+        # (artifact name, targeted package) pairs the marketplace serves with the universal artifact
+        universal_targets = []
+
+        def resolve(extension_id):
+            # One marketplace query per extension covers every version/platform combination
+            extension_details = list(get_vscode_extensions(extensionId=extension_id, max_page=1))
+            if not extension_details:
+                raise CommandError(f'{extension_id} not found')
+            manifest_cache = {}
+            results = {}
+            for vscode_version in vscode_versions:
+                for platform in platforms:
+                    result = find_compatible_version(extension_details[0], vscode_version, platform, manifest_cache)
+                    cache_compatible_version(extension_id, vscode_version, platform, result)
+                    results[(vscode_version, platform)] = result
+            published = {(version.get('version'), version.get('targetPlatform'))
+                         for version in extension_details[0].get('versions', [])}
+            return results, published
+
+        self.stdout.write(f'Resolving {len(extensions)} extensions for {len(vscode_versions)} VS Code versions '
+                          f'and {len(platforms)} platforms')
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            futures = {extension_id: executor.submit(resolve, extension_id) for extension_id in extensions}
+            for extension_id, future in futures.items():
+                try:
+                    results, published = future.result()
+                except Exception as e:
+                    report.append({'id': extension_id, 'status': 'failed', 'error': str(e)})
+                    continue
+                publisher, extension = extension_id.split('.', 1)
+                for (vscode_version, platform), result in results.items():
+                    entry = {'id': extension_id, 'vscodeVersion': vscode_version, 'platform': platform}
+                    if not result:
+                        entry['status'] = 'incompatible'
+                        report.append(entry)
+                        continue
+                    # Universal versions have no target and are stored once under their plain name,
+                    # which every download path (browse UI, bulk jobs, bundle_extensions) looks up
+                    vsix = VsixPackage(publisher, extension, result['version'], result.get('targetPlatform'))
+                    artifacts.setdefault(vsix.get_cache_name(), vsix)
+                    if not vsix.target and (vsix.version, platform) not in published:
+                        # Requests for this platform are answered with the universal package, let them reuse it
+                        universal_targets.append((vsix.get_cache_name(),
+                                                  VsixPackage(publisher, extension, vsix.version, platform)))
+                    entry.update(version=result['version'], status='resolved', file=vsix.get_cache_name())
+                    report.append(entry)
+
+        fetched = {}
+        if not options['resolve_only']:
+            tmp_dir = get_tmp_dir()
+            self.stdout.write(f'Fetching {len(artifacts)} packages')
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                futures = {name: executor.submit(download_vsix, vsix, tmp_dir) for name, vsix in artifacts.items()}
+                for name, future in futures.items():
+                    try:
+                        _, cached = future.result()
+                        fetched[name] = 'cached' if cached else 'downloaded'
+                    except Exception as e:
+                        fetched[name] = f'failed: {e}'
+            for name, target_vsix in universal_targets:
+                if fetched.get(name) in ('cached', 'downloaded'):
+                    mark_universal(target_vsix, tmp_dir)
+            for entry in report:
+                if entry.get('file') in fetched:
+                    entry['status'] = fetched[entry['file']]
+
+        for entry in report:
+            line = f"{entry['status']:>12}  {entry['id']}"
+            if 'vscodeVersion' in entry:
+                line += f" {entry.get('version', '-')} (VS Code {entry['vscodeVersion']}, {entry['platform']})"
+            if 'error' in entry:
+                line += f" {entry['error']}"
+            self.stdout.write(line)
+
+        summary = {}
+        for entry in report:
+            status = entry['status'].split(':', 1)[0]
+            summary[status] = summary.get(status, 0) + 1
+        self.stdout.write(self.style.SUCCESS('Warmed: ' + ', '.join(f'{count} {status}' for status, count in summary.items())))
+
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as f:
+                json.dump({'summary': summary, 'entries': report}, f, indent=2)
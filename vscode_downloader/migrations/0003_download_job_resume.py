@@ -0,0 +1,28 @@
+# Generated by Django 5.1.15 on 2026-10-19 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vscode_downloader', '0002_download_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadjob',
+            name='items',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='downloadjob',
+            name='owner',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='downloadjob',
+            name='params',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.15 on 2026-10-19 18:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vscode_downloader', '0003_download_job_resume'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadjob',
+            name='cancelled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='downloadjob',
+            name='last_polled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
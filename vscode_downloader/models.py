@@ -20,4 +20,31 @@ class VsixPackage(models.Model):
         return url
 
     def get_vsix_name(self: Self) -> str:
-        return f"{self.publisher}.{self.extension}-{self.version}.vsix"
\ No newline at end of file
+        return f"{self.publisher}.{self.extension}-{self.version}.vsix"
+
+    def get_cache_name(self: Self) -> str:
+        # Platform specific packages share the same VSIX name, so keep them apart on disk
+        if self.target:
+            return f"{self.publisher}.{self.extension}-{self.version}@{self.target}.vsix"
+        return self.get_vsix_name()
+
+
+class DownloadJob(models.Model):
+    """Progress of a download job, shared by every worker process through the database"""
+    download_id = models.CharField(max_length=64, unique=True)
+    state = models.JSONField(default=dict)
+    # Input of a bulk job, kept so the job can be resumed after a restart
+    params = models.JSONField(null=True, blank=True)
+    # Resolved bundle entries of a bulk job and whether each one is downloaded
+    items = models.JSONField(default=list, blank=True)
+    # Worker process currently running the job
+    owner = models.CharField(max_length=255, blank=True)
+    # Set by the cancel endpoint, the running job stops at its next check
+    cancelled_at = models.DateTimeField(null=True, blank=True)
+    # Last status poll, jobs nobody polls any more are reclaimed
+    last_polled_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self: Self) -> str:
+        return f"{self.download_id} ({self.state.get('status', 'unknown')})"
@@ -0,0 +1,210 @@
+"""
+Opt-in profiling of download jobs.
+
+A profiled job records a timeline of spans (resolution, upstream waits and
+transfers, disk writes, ZIP compression, status updates) and, in 'sample'
+mode, the stack of the job thread at a fixed interval. The trace is written
+to tmp/traces/<download_id>.json when the job ends and can be fetched as a
+Trace Event file (Perfetto, chrome://tracing, speedscope) or as folded stacks
+for flamegraph.pl.
+
+Instrumented code calls span(), which does nothing unless the current thread
+is running a profiled job. Hot loops fetch current_trace() once and account
+their time with JobTrace.add() only when it is not None.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+
+SPANS = 'spans'
+SAMPLE = 'sample'
+
+_current_trace = contextvars.ContextVar('job_trace', default=None)
+
+
+def profile_mode(value=None):
+    """Normalise a request's ``profile`` option, falling back to VSCODE_DOWNLOADER_PROFILE"""
+    if value is None:
+        value = settings.VSCODE_DOWNLOADER_PROFILE
+    if value is True:
+        return SPANS
+    if value in (SPANS, SAMPLE):
+        return value
+    if not value:
+        return None
+    raise ValueError(f'Unknown profile mode: {value}')
+
+
+class JobTrace:
+    def __init__(self, download_id, sample_interval=0):
+        self.download_id = download_id
+        self.sample_interval = sample_interval
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.events = []
+        # Self time in microseconds per span stack, and stack samples of the job thread
+        self.stacks = defaultdict(int)
+        self.samples = defaultdict(int)
+        self.frames = defaultdict(list)
+        self.lock = threading.Lock()
+        self.thread_id = threading.get_ident()
+        self.stop_sampling = threading.Event()
+        self.token = None
+        self.root = None
+
+    def _now(self):
+        return int((time.perf_counter() - self.started) * 1_000_000)
+
+    @contextmanager
+    def span(self, name, **args):
+        stack = self.frames[threading.get_ident()]
+        frame = {'name': name, 'start': self._now(), 'children': 0, 'accumulated': defaultdict(float)}
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            duration = self._now() - frame['start']
+            path = ';'.join(f['name'] for f in stack)
+            stack.pop()
+            if stack:
+                stack[-1]['children'] += duration
+            for key, seconds in frame['accumulated'].items():
+                args[f'{key}_ms'] = round(seconds * 1000, 3)
+            with self.lock:
+                self.stacks[path] += max(duration - frame['children'], 0)
+                self.events.append({
+                    'name': name, 'ph': 'X', 'ts': frame['start'], 'dur': duration,
+                    'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+                })
+
+    def add(self, name, seconds):
+        """Account time spent in a hot loop (e.g. per chunk) without recording a span for every call"""
+        stack = self.frames[threading.get_ident()]
+        if not stack:
+            return
+        microseconds = int(seconds * 1_000_000)
+        stack[-1]['children'] += microseconds
+        stack[-1]['accumulated'][name] += seconds
+        path = ';'.join(f['name'] for f in stack)
+        with self.lock:
+            self.stacks[f'{path};{name}'] += microseconds
+
+    def _sample(self):
+        while not self.stop_sampling.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({os.path.basename(code.co_filename)})'.replace(';', ':'))
+                frame = frame.f_back
+            if names:
+                with self.lock:
+                    self.samples[';'.join(reversed(names))] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'traceEvents': sorted(self.events, key=lambda event: event['ts']),
+                'displayTimeUnit': 'ms',
+                'otherData': {
+                    'download_id': self.download_id,
+                    'started_at': self.started_at,
+                    'sample_interval': self.sample_interval,
+                },
+                'stacks': dict(self.stacks),
+                'samples': dict(self.samples),
+            }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def span(name, **args):
+    """Record a span on the current job's trace, if it is being profiled"""
+    trace = _current_trace.get()
+    if trace is None:
+        return nullcontext()
+    return trace.span(name, **args)
+
+
+def start_trace(download_id, mode):
+    """
+    Start profiling the job running in this thread. Returns the trace, or None
+    when ``mode`` is off; pass it to finish_trace() when the job ends.
+    """
+    if not mode:
+        return None
+    sample_interval = settings.VSCODE_DOWNLOADER_PROFILE_SAMPLE_INTERVAL if mode == SAMPLE else 0
+    trace = JobTrace(download_id, sample_interval)
+    trace.token = _current_trace.set(trace)
+    trace.root = trace.span('job', download_id=download_id)
+    trace.root.__enter__()
+    if sample_interval:
+        threading.Thread(target=trace._sample, daemon=True).start()
+    return trace
+
+
+def finish_trace(trace):
+    if trace is None:
+        return
+    trace.stop_sampling.set()
+    trace.root.__exit__(None, None, None)
+    _current_trace.reset(trace.token)
+    try:
+        save_trace(trace)
+    except OSError as e:
+        print(f'Could not save the trace of {trace.download_id}: {str(e)}')
+
+
+def get_trace_dir():
+    trace_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'traces')
+    os.makedirs(trace_dir, exist_ok=True)
+    return trace_dir
+
+
+def get_trace_path(download_id):
+    name = f'{download_id}.json'
+    # The id comes from the URL, never let it escape the trace directory
+    if os.path.basename(name) != name or name.startswith('.'):
+        raise ValueError(f'Invalid download id: {download_id}')
+    return os.path.join(get_trace_dir(), name)
+
+
+def save_trace(trace):
+    path = get_trace_path(trace.download_id)
+    with open(f'{path}.part', 'w') as f:
+        json.dump(trace.to_dict(), f)
+    os.replace(f'{path}.part', path)
+
+
+def load_trace(download_id):
+    try:
+        with open(get_trace_path(download_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def fold(stacks):
+    """Collapsed stack lines ("a;b;c 123") as read by flamegraph.pl and speedscope"""
+    return ''.join(f'{stack} {value}\n' for stack, value in sorted(stacks.items()) if value)
+
+
+def cleanup_traces(max_age):
+    trace_dir = get_trace_dir()
+    now = time.time()
+    for name in os.listdir(trace_dir):
+        path = os.path.join(trace_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
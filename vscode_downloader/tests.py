@@ -1,3 +1,1146 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+import requests
+from django.core import signing
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import gallery, upstream, views
+from .bundles import BundleWriter, file_sha256
+from .models import DownloadJob, VsixPackage
+from .views import accepted_encodings, compressed_json_response
+from .upstream import BACKGROUND, INTERACTIVE, UpstreamScheduler
+
+VSIX_MANIFEST = '''<?xml version="1.0" encoding="utf-8"?>
+<PackageManifest Version="2.0.0" xmlns="http://schemas.microsoft.com/developer/vsx-schema/2011">
+  <Metadata>
+    <Identity Language="en-US" Id="{name}" Version="{version}" Publisher="{publisher}"{target}/>
+    <Properties>
+      <Property Id="Microsoft.VisualStudio.Code.Engine" Value="{engine}" />
+    </Properties>
+  </Metadata>
+</PackageManifest>
+'''
+
+
+def make_vsix(path, publisher, name, version, target_platform=None, engine='^1.80.0', files=None, **fields):
+    """Write a minimal VSIX with a package.json (plus any ``fields``), a vsixmanifest and any extra ``files``"""
+    manifest = {'publisher': publisher, 'name': name, 'version': version, 'engines': {'vscode': engine},
+                'displayName': name.title(), 'description': f'The {name} extension', **fields}
+    target = f' TargetPlatform="{target_platform}"' if target_platform else ''
+    with zipfile.ZipFile(path, 'w') as vsix_file:
+        vsix_file.writestr('extension/package.json', json.dumps(manifest))
+        vsix_file.writestr('extension.vsixmanifest', VSIX_MANIFEST.format(
+            publisher=publisher, name=name, version=version, target=target, engine=engine))
+        for member, content in (files or {}).items():
+            vsix_file.writestr(member, content)
+    return path
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error')
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+class FakeMarketplace:
+    """
+    Marketplace answering extension queries and VSIX downloads from published
+    fixtures. Like the real one, a targeted download falls back to the
+    universal package when the version has no package for that target.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.packages = {}
+        self.downloads = []
+
+    def publish(self, publisher, name, version, target_platform=None, engine='^1.80.0'):
+        path = os.path.join(self.directory, f'published-{publisher}.{name}-{version}-{target_platform}.vsix')
+        make_vsix(path, publisher, name, version, target_platform, engine)
+        with open(path, 'rb') as f:
+            self.packages[(publisher, name, version, target_platform)] = {'content': f.read(), 'engine': engine}
+
+    def get_vscode_extensions(self, extensionId=None, **kwargs):
+        publisher, name = extensionId.split('.', 1)
+        versions = [
+            {'version': version, 'targetPlatform': target_platform,
+             'properties': [{'key': 'Microsoft.VisualStudio.Code.Engine', 'value': package['engine']}]}
+            for (package_publisher, package_name, version, target_platform), package in self.packages.items()
+            if (package_publisher, package_name) == (publisher, name)
+        ]
+        if not versions:
+            return []
+        versions.sort(key=lambda version: version['version'], reverse=True)
+        return [{'publisher': {'publisherName': publisher}, 'extensionName': name, 'versions': versions}]
+
+    @contextmanager
+    def request(self, method, url, **kwargs):
+        url = urlsplit(url)
+        parts = url.path.split('/')
+        publisher, name, version = parts[-5], parts[-3], parts[-2]
+        target_platform = parse_qs(url.query).get('targetPlatform', [None])[0]
+        self.downloads.append(VsixPackage(publisher, name, version, target_platform).get_cache_name())
+        package = (self.packages.get((publisher, name, version, target_platform))
+                   or self.packages.get((publisher, name, version, None)))
+        if package is None:
+            yield FakeResponse(404)
+            return
+        yield FakeResponse(200, {'content-length': str(len(package['content']))}, package['content'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LocalStoreTestCase(TestCase):
+    """Runs against a temporary VSIX store and a FakeMarketplace"""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.tmp_dir = os.path.join(directory.name, 'tmp')
+        os.makedirs(self.tmp_dir)
+        self.marketplace = FakeMarketplace(directory.name)
+        for target, replacement in [('get_tmp_dir', lambda: self.tmp_dir),
+                                    ('upstream_request', self.marketplace.request),
+                                    ('get_vscode_extensions', self.marketplace.get_vscode_extensions)]:
+            patcher = mock.patch.object(views, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+
+    def cached_files(self):
+        return sorted(name for name in os.listdir(self.tmp_dir) if name.endswith('.vsix'))
+
+    def start_job(self, extensions, **params):
+        download_id = views.create_download_id()
+        params['extensions'] = extensions
+        DownloadJob.objects.create(download_id=download_id, params=params)
+        return download_id
+
+    def run_job(self, extensions, **params):
+        """Run a bulk job in this thread and return its id and final state"""
+        download_id = self.start_job(extensions, **params)
+        views.run_bulk_job(download_id)
+        return download_id, views.get_download_status(download_id)
+
+
+def make_scheduler(**kwargs):
+    options = {'rate': 1000, 'burst': 1000, 'min_concurrency': 1, 'max_concurrency': 8, 'initial_concurrency': 4}
+    options.update(kwargs)
+    return UpstreamScheduler(**options)
+
+
+class UpstreamSchedulerTests(SimpleTestCase):
+    def test_success_raises_limit_up_to_max(self):
+        scheduler = make_scheduler(max_concurrency=5)
+        for _ in range(50):
+            scheduler.acquire()
+            scheduler.release(200)
+        self.assertEqual(scheduler.limit, 5)
+
+    def test_throttled_response_halves_limit_down_to_min(self):
+        scheduler = make_scheduler(initial_concurrency=8)
+        scheduler.acquire()
+        scheduler.release(503)
+        self.assertEqual(scheduler.limit, 4)
+        for _ in range(5):
+            scheduler.acquire()
+            scheduler.release(429)
+        self.assertEqual(scheduler.limit, 1)
+
+    def test_only_retry_after_pauses_traffic(self):
+        scheduler = make_scheduler()
+        scheduler.acquire()
+        scheduler.release(500)
+        self.assertEqual(scheduler.snapshot()['paused_for'], 0)
+        scheduler.acquire()
+        scheduler.release(429, retry_after=30)
+        self.assertGreater(scheduler.snapshot()['paused_for'], 25)
+
+    def test_background_keeps_a_slot_for_interactive(self):
+        scheduler = make_scheduler(initial_concurrency=2)
+        scheduler.acquire(BACKGROUND)
+        acquired = threading.Event()
+
+        def background():
+            scheduler.acquire(BACKGROUND)
+            acquired.set()
+
+        threading.Thread(target=background, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+        # The reserved slot is still free for an interactive request
+        scheduler.acquire(INTERACTIVE)
+        scheduler.release(200)
+        scheduler.release(200)
+        self.assertTrue(acquired.wait(1))
+
+    def test_background_yields_to_waiting_interactive(self):
+        scheduler = make_scheduler(initial_concurrency=1)
+        scheduler.acquire(INTERACTIVE)
+        order = []
+
+        def request(priority):
+            scheduler.acquire(priority)
+            order.append(priority)
+            scheduler.release(200)
+
+        background = threading.Thread(target=request, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=request, args=(INTERACTIVE,))
+        interactive.start()
+        time.sleep(0.05)
+        scheduler.release(200)
+        background.join(1)
+        interactive.join(1)
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+
+    def test_token_bucket_limits_rate(self):
+        scheduler = make_scheduler(rate=20, burst=1)
+        started = time.monotonic()
+        for _ in range(3):
+            scheduler.acquire()
+            scheduler.release(200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def make_workers(self, count, **kwargs):
+        """Schedulers of separate worker processes, sharing a file based cache like the default settings"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return [make_scheduler(shared=FileBasedCache(directory.name, {}), **kwargs) for _ in range(count)]
+
+    def test_retry_after_pauses_other_workers(self):
+        first, second = self.make_workers(2)
+        first.acquire()
+        first.release(429, retry_after=0.3)
+        started = time.monotonic()
+        second.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        second.release(200)
+
+    def test_throttling_lowers_the_limit_of_other_workers(self):
+        first, second = self.make_workers(2, initial_concurrency=8)
+        first.acquire()
+        first.release(503)
+        second.acquire()
+        self.assertEqual(second.limit, 4)
+        second.release(200)
+        # Each decrease is adopted once, the workers then recover on their own
+        with mock.patch.object(upstream, 'SHARED_SYNC_INTERVAL', 0):
+            for _ in range(3):
+                second.acquire()
+                second.release(200)
+        self.assertGreater(second.limit, 4.5)
+        self.assertEqual(first.limit, 4)
+
+
+class UpstreamRequestTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = make_scheduler()
+        patcher = mock.patch.object(upstream, 'scheduler', self.scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sleep = mock.patch.object(upstream.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_server_error_backs_off_without_pausing(self):
+        session = FakeSession([FakeResponse(500), FakeResponse(502), FakeResponse(200)])
+        with upstream.upstream_request('GET', 'https://example.com', session=session) as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [0.5, 1])
+        self.assertEqual(self.scheduler.snapshot()['paused_for'], 0)
+        self.assertEqual(self.scheduler.active, 0)
+
+    def test_retry_after_pauses_all_traffic(self):
+        session = FakeSession([FakeResponse(429, {'Retry-After': '0.2'}), FakeResponse(200)])
+        started = time.monotonic()
+        with upstream.upstream_request('GET', 'https://example.com', session=session) as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.sleep.assert_not_called()
+
+    def test_gives_up_after_retries(self):
+        session = FakeSession([FakeResponse(503)] * 3)
+        with upstream.upstream_request('GET', 'https://example.com', session=session, retries=2) as response:
+            self.assertEqual(response.status_code, 503)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(self.scheduler.active, 0)
+
+    def proxy_used(self):
+        """The proxies a pooled session hands to its adapter for a marketplace request"""
+        sent = {}
+
+        class RecordingAdapter(requests.adapters.HTTPAdapter):
+            def send(self, request, **kwargs):
+                sent.update(kwargs['proxies'])
+                response = requests.Response()
+                response.status_code = 200
+                response.raw = io.BytesIO(b'{}')
+                response.request = request
+                return response
+
+        with mock.patch.object(upstream, '_session', None):
+            upstream.get_session().mount('https://', RecordingAdapter())
+            upstream.upstream_get('https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery')
+        return sent.get('https')
+
+    @mock.patch.dict(os.environ, {'HTTPS_PROXY': 'http://envproxy:1', 'NO_PROXY': ''})
+    def test_configured_proxy_wins_over_environment(self):
+        with override_settings(VSCODE_DOWNLOADER_UPSTREAM_PROXY='http://configured:3128'):
+            self.assertEqual(self.proxy_used(), 'http://configured:3128')
+        with override_settings(VSCODE_DOWNLOADER_UPSTREAM_PROXY=''):
+            self.assertEqual(self.proxy_used(), 'http://envproxy:1')
+
+
+class CompressedJsonResponseTests(SimpleTestCase):
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('gzip, br;q=0, *;q=0.5'), {'gzip': 1.0, 'br': 0.0, '*': 0.5})
+        self.assertEqual(accepted_encodings('GZip ; Q=0.8,'), {'gzip': 0.8})
+
+    def test_refused_encoding_is_not_used(self):
+        data = {'value': 'x' * 500}
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(compressed_json_response(request, data).has_header('Content-Encoding'))
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+        self.assertEqual(compressed_json_response(request, data)['Content-Encoding'], 'gzip')
+
+
+class BundleWriterTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.random = random.Random(0)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(self.random.randbytes(size))
+        return path
+
+    def read_index(self, stem):
+        with open(f'{stem}.index.json', encoding='utf-8') as f:
+            return json.load(f)
+
+    def assert_volumes_valid(self, stem):
+        index = self.read_index(stem)
+        with open(f'{stem}.sha256', encoding='utf-8') as f:
+            checksums = dict(line.split()[::-1] for line in f)
+        for volume in index['volumes']:
+            path = os.path.join(self.dir, volume['name'])
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            self.assertEqual(os.path.getsize(path), volume['size'])
+            self.assertEqual(digest, volume['sha256'])
+            self.assertEqual(checksums[volume['name']], digest)
+            with zipfile.ZipFile(path) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.namelist(), volume['entries'])
+        return index['volumes']
+
+    def test_volumes_stay_within_size_limit(self):
+        volume_size = 20000
+        stem = os.path.join(self.dir, 'bundle')
+        bundle = BundleWriter(f'{stem}.zip', volume_size)
+        names = []
+        for i in range(40):
+            name = f'linux-x64/publisher.extension-{i}-1.0.{i}.vsix'
+            bundle.add(self.make_file(f'{i}.vsix', self.random.randint(1, 6000)), name)
+            names.append(name)
+        bundle.close()
+
+        volumes = self.assert_volumes_valid(stem)
+        self.assertGreater(len(volumes), 1)
+        for volume in volumes:
+            self.assertLessEqual(volume['size'], volume_size)
+        self.assertEqual([name for volume in volumes for name in volume['entries']], names)
+
+    def write_bundle(self, name, paths, volume_size):
+        stem = os.path.join(self.dir, name)
+        bundle = BundleWriter(f'{stem}.zip', volume_size)
+        for i, path in enumerate(paths):
+            bundle.add(path, f'extension-{i}.vsix')
+        bundle.close()
+        return self.assert_volumes_valid(stem)
+
+    def assert_estimate_is_tight(self, paths):
+        def write(name, volume_size):
+            return self.write_bundle(name, paths, volume_size)
+
+        # Size of a volume holding exactly three entries
+        three_entries = write('measure', 3 * 1000 + 1000)[0]['size']
+        self.assertEqual(len(write('measure-check', three_entries + 1000)[0]['entries']), 3)
+
+        # One byte less must not fit three entries
+        volumes = write('below', three_entries - 1)
+        self.assertEqual([len(volume['entries']) for volume in volumes], [2, 2, 2])
+        self.assertTrue(all(volume['size'] < three_entries for volume in volumes))
+        volumes = write('exact', three_entries)
+        self.assertEqual([len(volume['entries']) for volume in volumes], [3, 3])
+
+    def test_size_estimate_is_tight(self):
+        self.assert_estimate_is_tight([self.make_file(f'{i}.vsix', 1000) for i in range(6)])
+
+    def test_size_estimate_counts_zip64_records(self):
+        # Past ZIP64_LIMIT the central records get zip64 extras and the volume a zip64 end record.
+        # The limit is shrunk so the third entry's offset and the central directory cross it.
+        paths = [self.make_file(f'{i}.vsix', 1000) for i in range(6)]
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 1500):
+            self.assert_estimate_is_tight(paths)
+
+    def test_volumes_with_zip64_records_stay_within_size_limit(self):
+        volume_size = 20000
+        paths = [self.make_file(f'{i}.vsix', self.random.randint(1, 3000)) for i in range(60)]
+        # Entries larger than the limit also get zip64 sizes in their local header and data descriptor
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 2000):
+            volumes = self.write_bundle('bundle', paths, volume_size)
+
+        self.assertGreater(len(volumes), 1)
+        for volume in volumes:
+            self.assertLessEqual(volume['size'], volume_size)
+        self.assertEqual([name for volume in volumes for name in volume['entries']],
+                         [f'extension-{i}.vsix' for i in range(len(paths))])
+
+    def test_oversized_entry_gets_its_own_volume(self):
+        stem = os.path.join(self.dir, 'bundle')
+        bundle = BundleWriter(f'{stem}.zip', 5000)
+        bundle.add(self.make_file('small-1.vsix', 1000), 'small-1.vsix')
+        bundle.add(self.make_file('large.vsix', 12000), 'large.vsix')
+        bundle.add(self.make_file('small-2.vsix', 1000), 'small-2.vsix')
+        bundle.close()
+
+        volumes = self.assert_volumes_valid(stem)
+        self.assertEqual([volume['entries'] for volume in volumes], [['small-1.vsix'], ['large.vsix'], ['small-2.vsix']])
+        self.assertGreater(volumes[1]['size'], 5000)
+        self.assertLessEqual(volumes[0]['size'], 5000)
+        self.assertLessEqual(volumes[2]['size'], 5000)
+
+    def test_abort_removes_everything_written(self):
+        stem = os.path.join(self.dir, 'bundle')
+        bundle = BundleWriter(f'{stem}.zip', 1500)
+        for i in range(3):
+            bundle.add(self.make_file(f'{i}.vsix', 1000), f'{i}.vsix')
+        self.assertEqual(len(bundle.volumes), 3)
+        bundle.abort()
+
+        single = BundleWriter(os.path.join(self.dir, 'single.zip'))
+        single.add(os.path.join(self.dir, '0.vsix'), '0.vsix')
+        single.abort()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['0.vsix', '1.vsix', '2.vsix'])
+
+    def test_empty_bundle(self):
+        stem = os.path.join(self.dir, 'bundle')
+        files = BundleWriter(f'{stem}.zip', 5000).close()
+        volumes = self.assert_volumes_valid(stem)
+        self.assertEqual([volume['entries'] for volume in volumes], [[]])
+        self.assertEqual(len(files), 3)
+
+        path = os.path.join(self.dir, 'single.zip')
+        self.assertEqual(BundleWriter(path).close(), [path])
+        with zipfile.ZipFile(path) as zip_file:
+            self.assertEqual(zip_file.namelist(), [])
+
+
+class DownloadVsixTests(LocalStoreTestCase):
+    def test_universal_package_is_stored_once(self):
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        path, cached = views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'linux-x64'))
+        self.assertFalse(cached)
+        self.assertEqual(os.path.basename(path), 'pub.tool-1.0.0.vsix')
+        self.assertEqual(self.cached_files(), ['pub.tool-1.0.0.vsix'])
+
+        # The same target, and untargeted requests, are served from that file
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'linux-x64')), (path, True))
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0')), (path, True))
+        self.assertEqual(self.marketplace.downloads, ['pub.tool-1.0.0@linux-x64.vsix'])
+
+    def test_other_targets_ask_the_marketplace_first(self):
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        self.marketplace.publish('pub', 'tool', '1.0.0', 'darwin-arm64')
+        universal_path, _ = views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'linux-x64'))
+
+        # Published both ways: the platform package is used for its target
+        path, cached = views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'darwin-arm64'))
+        self.assertFalse(cached)
+        self.assertEqual(os.path.basename(path), 'pub.tool-1.0.0@darwin-arm64.vsix')
+        self.assertEqual(views.read_vsix_identity(path)[0], 'darwin-arm64')
+
+        # A target answered with the universal package reuses the stored file from then on
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'win32-x64')), (universal_path, False))
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'win32-x64')), (universal_path, True))
+        self.assertEqual(self.marketplace.downloads, [
+            'pub.tool-1.0.0@linux-x64.vsix', 'pub.tool-1.0.0@darwin-arm64.vsix', 'pub.tool-1.0.0@win32-x64.vsix',
+        ])
+
+    def test_platform_package_under_plain_name_is_not_reused(self):
+        # Older versions cached platform packages under the plain name
+        self.marketplace.publish('pub', 'native', '2.0.0', 'darwin-arm64')
+        make_vsix(os.path.join(self.tmp_dir, 'pub.native-2.0.0.vsix'), 'pub', 'native', '2.0.0', 'win32-x64')
+        vsix = VsixPackage('pub', 'native', '2.0.0', 'darwin-arm64')
+        views.mark_universal(vsix)
+
+        path, cached = views.download_vsix(vsix)
+        self.assertFalse(cached)
+        self.assertEqual(os.path.basename(path), 'pub.native-2.0.0@darwin-arm64.vsix')
+        self.assertEqual(views.read_vsix_identity(path)[0], 'darwin-arm64')
+
+    def test_replaced_package_gets_fresh_metadata(self):
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        plain_path = make_vsix(os.path.join(self.tmp_dir, 'pub.tool-1.0.0.vsix'), 'pub', 'tool', '1.0.0', 'win32-x64')
+        self.assertEqual(views.get_vsix_metadata(plain_path)['target_platform'], 'win32-x64')
+
+        path, _ = views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'linux-x64'))
+        self.assertEqual(path, plain_path)
+        self.assertIsNone(views.get_vsix_metadata(path)['target_platform'])
+
+    def read_bundle(self, download_id, platform=None):
+        with zipfile.ZipFile(views.get_bundle_path(download_id, platform)) as zip_file:
+            return {
+                name: views.ElementTree.fromstring(
+                    zipfile.ZipFile(zip_file.open(name)).read('extension.vsixmanifest')
+                ).find('.//{*}Identity').get('TargetPlatform')
+                for name in zip_file.namelist()
+            }
+
+    def publish_mixed(self):
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        for platform in ('linux-x64', 'win32-x64'):
+            self.marketplace.publish('pub', 'native', '2.0.0', platform)
+        return [{'id': 'pub.tool'}, {'id': 'pub.native'}]
+
+    def test_folders_layout_shares_universal_packages(self):
+        download_id, status = self.run_job(self.publish_mixed(), target_platforms=['linux-x64', 'win32-x64'],
+                                           vscode_version='1.95.0', layout='folders')
+        self.assertEqual(status['status'], 'completed')
+        self.assertEqual(self.read_bundle(download_id), {
+            'linux-x64/pub.tool-1.0.0.vsix': None,
+            'linux-x64/pub.native-2.0.0.vsix': 'linux-x64',
+            'win32-x64/pub.tool-1.0.0.vsix': None,
+            'win32-x64/pub.native-2.0.0.vsix': 'win32-x64',
+        })
+        # The universal package was downloaded once for both platforms
+        self.assertEqual(sorted(self.marketplace.downloads), [
+            'pub.native-2.0.0@linux-x64.vsix', 'pub.native-2.0.0@win32-x64.vsix', 'pub.tool-1.0.0.vsix',
+        ])
+
+    def test_archives_layout_writes_one_bundle_per_platform(self):
+        download_id, status = self.run_job(self.publish_mixed(), target_platforms=['linux-x64', 'win32-x64'],
+                                           vscode_version='1.95.0', layout='archives')
+        self.assertEqual(status['status'], 'completed')
+        for platform in ('linux-x64', 'win32-x64'):
+            self.assertEqual(self.read_bundle(download_id, platform), {
+                'pub.tool-1.0.0.vsix': None,
+                'pub.native-2.0.0.vsix': platform,
+            })
+        self.assertEqual(len(self.marketplace.downloads), 3)
+
+    def test_legacy_job_with_targeted_universal_packages(self):
+        # The browse UI sends a target for every extension, even universal ones
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        self.marketplace.publish('pub', 'other', '3.0.0')
+        for platform in ('linux-x64', 'linux-x64', 'win32-x64'):
+            download_id, status = self.run_job([
+                {'publisher': 'pub', 'extension': name, 'version': version, 'targetPlatform': platform}
+                for name, version in (('tool', '1.0.0'), ('other', '3.0.0'))
+            ])
+            self.assertEqual(status['status'], 'completed')
+            self.assertEqual(self.read_bundle(download_id), {'pub.tool-1.0.0.vsix': None, 'pub.other-3.0.0.vsix': None})
+        self.assertEqual(self.cached_files(), ['pub.other-3.0.0.vsix', 'pub.tool-1.0.0.vsix'])
+        self.assertEqual(len(self.marketplace.downloads), 4)
+
+    def test_warm_cache_lets_targeted_requests_reuse_universal_packages(self):
+        from .management.commands import warm_cache
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        self.marketplace.publish('pub', 'tool', '1.0.0', 'darwin-arm64')
+        policy = os.path.join(self.tmp_dir, 'policy.json')
+        with open(policy, 'w') as f:
+            json.dump({'extensions': ['pub.tool'], 'vscodeVersions': ['1.95.0'],
+                       'platforms': ['linux-x64', 'darwin-arm64']}, f)
+        with mock.patch.object(warm_cache, 'get_vscode_extensions', self.marketplace.get_vscode_extensions), \
+                mock.patch.object(warm_cache, 'get_tmp_dir', lambda: self.tmp_dir):
+            call_command('warm_cache', policy, stdout=io.StringIO())
+        self.assertEqual(self.marketplace.downloads, ['pub.tool-1.0.0.vsix', 'pub.tool-1.0.0@darwin-arm64.vsix'])
+
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'linux-x64'))[1], True)
+        self.assertEqual(views.download_vsix(VsixPackage('pub', 'tool', '1.0.0', 'darwin-arm64'))[1], True)
+        self.assertEqual(len(self.marketplace.downloads), 2)
+
+
+class BundleExtensionsCommandTests(LocalStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        from .management.commands import bundle_extensions
+        patcher = mock.patch.object(bundle_extensions, 'get_tmp_dir', lambda: self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.out_dir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(self.out_dir)
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        for platform in ('linux-x64', 'win32-x64'):
+            self.marketplace.publish('pub', 'native', '2.0.0', platform)
+
+    def bundle(self, *args):
+        call_command('bundle_extensions', *args, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def write_list(self, *extension_ids):
+        path = os.path.join(self.out_dir, 'extensions.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(extension_ids))
+        return path
+
+    def bundle_names(self, name):
+        with zipfile.ZipFile(os.path.join(self.out_dir, name)) as zip_file:
+            return sorted(zip_file.namelist())
+
+    def write_lock(self):
+        lock = os.path.join(self.out_dir, 'extensions.lock.json')
+        self.bundle(self.write_list('pub.tool', 'pub.native'), '--vscode-version', '1.95.0',
+                    '--platform', 'linux-x64', '--platform', 'win32-x64',
+                    '--output', os.path.join(self.out_dir, 'resolved.zip'), '--write-lock', lock)
+        return lock
+
+    def test_lockfile_round_trip(self):
+        lock = self.write_lock()
+        with open(lock) as f:
+            entries = {(entry['id'], entry['targetPlatform']): entry for entry in json.load(f)['extensions']}
+        self.assertEqual(entries[('pub.tool', None)]['platforms'], ['linux-x64', 'win32-x64'])
+        self.assertEqual(entries[('pub.native', 'linux-x64')]['platforms'], ['linux-x64'])
+        for entry in entries.values():
+            path = os.path.join(self.tmp_dir, VsixPackage(*entry['id'].split('.'), entry['version'],
+                                                          entry['targetPlatform']).get_cache_name())
+            self.assertEqual(entry['sha256'], file_sha256(path))
+
+        # A locked build never queries the marketplace, and re-downloads what is missing from the cache
+        for name in self.cached_files():
+            os.remove(os.path.join(self.tmp_dir, name))
+        downloads = len(self.marketplace.downloads)
+        with mock.patch.object(views, 'get_vscode_extensions', side_effect=AssertionError('queried')):
+            self.bundle('--lock', lock, '--output', os.path.join(self.out_dir, 'locked.zip'))
+        self.assertEqual(len(self.marketplace.downloads), downloads + 3)
+        self.assertEqual(self.bundle_names('locked.zip'), self.bundle_names('resolved.zip'))
+        self.assertEqual(self.bundle_names('locked.zip'), [
+            'linux-x64/pub.native-2.0.0.vsix', 'linux-x64/pub.tool-1.0.0.vsix',
+            'win32-x64/pub.native-2.0.0.vsix', 'win32-x64/pub.tool-1.0.0.vsix',
+        ])
+
+    def test_corrupt_cache_entry_is_downloaded_again(self):
+        lock = self.write_lock()
+        with open(os.path.join(self.tmp_dir, 'pub.tool-1.0.0.vsix'), 'wb') as f:
+            f.write(b'corrupt')
+        self.bundle('--lock', lock, '--output', os.path.join(self.out_dir, 'locked.zip'))
+        self.assertEqual(self.marketplace.downloads[-1], 'pub.tool-1.0.0.vsix')
+        with zipfile.ZipFile(os.path.join(self.out_dir, 'locked.zip')) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+
+    def test_changed_package_fails_the_locked_build(self):
+        lock = self.write_lock()
+        os.remove(os.path.join(self.tmp_dir, 'pub.tool-1.0.0.vsix'))
+        # Republished with different content under the same version
+        self.marketplace.publish('pub', 'tool', '1.0.0', engine='^1.90.0')
+        with self.assertRaisesMessage(CommandError, '1 extension(s) could not be bundled'):
+            self.bundle('--lock', lock, '--output', os.path.join(self.out_dir, 'locked.zip'))
+        self.assertNotIn('pub.tool-1.0.0.vsix', self.cached_files())
+        self.assertNotIn('linux-x64/pub.tool-1.0.0.vsix', self.bundle_names('locked.zip'))
+
+    def test_pinned_versions_share_universal_packages(self):
+        lock = os.path.join(self.out_dir, 'extensions.lock.json')
+        self.bundle(self.write_list('pub.tool@1.0.0', 'pub.native@2.0.0'), '--vscode-version', '1.95.0',
+                    '--platform', 'linux-x64', '--platform', 'win32-x64',
+                    '--output', os.path.join(self.out_dir, 'pinned.zip'), '--write-lock', lock)
+        self.assertEqual(sorted(self.marketplace.downloads), [
+            'pub.native-2.0.0@linux-x64.vsix', 'pub.native-2.0.0@win32-x64.vsix', 'pub.tool-1.0.0.vsix',
+        ])
+        with open(lock) as f:
+            entries = {(entry['id'], entry['targetPlatform']): entry['platforms'] for entry in json.load(f)['extensions']}
+        self.assertEqual(entries, {
+            ('pub.tool', None): ['linux-x64', 'win32-x64'],
+            ('pub.native', 'linux-x64'): ['linux-x64'],
+            ('pub.native', 'win32-x64'): ['win32-x64'],
+        })
+
+    def test_pinned_version_must_be_published_for_every_platform(self):
+        stderr = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '3 extension(s) could not be bundled'):
+            call_command('bundle_extensions', self.write_list('pub.native@2.0.0', 'pub.tool@9.9.9'),
+                         '--vscode-version', '1.95.0', '--platform', 'linux-x64', '--platform', 'darwin-arm64',
+                         '--output', os.path.join(self.out_dir, 'pinned.zip'), stdout=io.StringIO(), stderr=stderr)
+        self.assertIn('pub.native@2.0.0 is not published for darwin-arm64', stderr.getvalue())
+        self.assertNotIn('pub.native@2.0.0 is not published for linux-x64', stderr.getvalue())
+        self.assertIn('pub.tool@9.9.9 is not published for linux-x64', stderr.getvalue())
+        self.assertEqual(self.bundle_names('pinned.zip'), ['linux-x64/pub.native-2.0.0.vsix'])
+
+    def test_lockfile_is_not_written_when_extensions_fail(self):
+        lock = os.path.join(self.out_dir, 'extensions.lock.json')
+        with self.assertRaises(CommandError):
+            self.bundle(self.write_list('pub.tool', 'pub.missing'), '--vscode-version', '1.95.0',
+                        '--output', os.path.join(self.out_dir, 'resolved.zip'), '--write-lock', lock)
+        self.assertFalse(os.path.exists(lock))
+
+
+class ExtensionDetailsApiTests(LocalStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        for patch in range(5):
+            self.marketplace.publish('pub', 'tool', f'1.0.{patch}')
+        self.marketplace.publish('pub', 'other', '2.0.0')
+
+    def get(self, extension_id, **params):
+        return self.client.get(reverse('vscode_downloader:api_extension_details', args=[extension_id]), params)
+
+    def test_versions_are_paged_with_a_cursor(self):
+        pages = []
+        response = self.get('pub.tool', versions=2, version_fields='version')
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            pages.append([version['version'] for version in data['versions']])
+            if not data['next_cursor']:
+                break
+            response = self.get('pub.tool', versions=2, version_fields='version', cursor=data['next_cursor'])
+        self.assertEqual(pages, [['1.0.4', '1.0.3'], ['1.0.2', '1.0.1'], ['1.0.0']])
+
+    def test_invalid_page_size_is_rejected(self):
+        for versions in ('0', '-3', 'abc'):
+            response = self.get('pub.tool', versions=versions)
+            self.assertEqual(response.status_code, 400, versions)
+            self.assertEqual(response.json(), {'error': f'Invalid versions: {versions}'})
+
+    def test_cursor_is_bound_to_its_extension(self):
+        cursor = self.get('pub.tool', versions=2).json()['next_cursor']
+        self.assertEqual(self.get('pub.tool', versions=2, cursor=cursor).status_code, 200)
+        self.assertEqual(self.get('pub.other', versions=2, cursor=cursor).status_code, 400)
+        self.assertEqual(self.get('pub.tool', versions=2, cursor=cursor + 'x').status_code, 400)
+
+
+class JobResumeTests(LocalStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.marketplace.publish('pub', 'tool', '1.0.0')
+        self.marketplace.publish('pub', 'other', '3.0.0')
+        self.extensions = [{'publisher': 'pub', 'extension': name, 'version': version}
+                           for name, version in (('tool', '1.0.0'), ('other', '3.0.0'))]
+        patcher = mock.patch.object(views.threading, 'Thread')
+        self.thread = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_stale(self, download_id, status='downloading', age=views.JOB_LEASE + 1):
+        """Leave the job as a worker that died while it was running would"""
+        job = DownloadJob.objects.get(download_id=download_id)
+        job.state = dict(job.state, status=status)
+        job.save()
+        DownloadJob.objects.filter(download_id=download_id).update(updated_at=timezone.now() - timedelta(seconds=age))
+
+    def resumed(self):
+        return [call.kwargs['args'][0] for call in self.thread.call_args_list if call.kwargs.get('target') is views.run_bulk_job]
+
+    def test_stale_job_is_claimed_exactly_once(self):
+        download_id = self.start_job(self.extensions)
+        views.set_download_status(download_id, 'downloading')
+        self.make_stale(download_id)
+        fresh_id = self.start_job(self.extensions)
+        views.set_download_status(fresh_id, 'downloading')
+
+        # Another worker claims the job between this worker's query and its claim
+        get_worker_id = views.get_worker_id
+        competitors = []
+
+        def competing_worker():
+            if not competitors:
+                competitors.append(get_worker_id())
+                views.resume_unfinished_jobs()
+            return get_worker_id()
+
+        with mock.patch.object(views, 'get_worker_id', side_effect=competing_worker):
+            views.resume_unfinished_jobs()
+        views.resume_unfinished_jobs()
+        self.assertEqual(self.resumed(), [download_id])
+        self.assertEqual(DownloadJob.objects.get(download_id=download_id).params['resume_attempts'], 1)
+
+    def test_job_is_failed_after_max_resumes(self):
+        download_id = self.start_job(self.extensions)
+        views.set_download_status(download_id, 'downloading', details=['Downloading pub.tool-1.0.0.vsix...'])
+        for attempt in range(views.JOB_MAX_RESUMES):
+            self.make_stale(download_id)
+            views.resume_unfinished_jobs()
+            self.assertEqual(len(self.resumed()), attempt + 1)
+        self.make_stale(download_id)
+        views.resume_unfinished_jobs()
+        self.assertEqual(len(self.resumed()), views.JOB_MAX_RESUMES)
+        status = views.get_download_status(download_id)
+        self.assertEqual(status['status'], 'error')
+        self.assertEqual(status['details'][-1], f'✗ Error: Gave up after {views.JOB_MAX_RESUMES} interrupted attempts')
+
+        # Failed jobs are no longer kept for resuming
+        self.make_stale(download_id, status='error', age=views.BUNDLE_MAX_AGE + 1)
+        views.cleanup_download_jobs()
+        self.assertFalse(DownloadJob.objects.filter(download_id=download_id).exists())
+
+    def test_resumed_job_only_downloads_what_is_not_cached(self):
+        download_id, status = self.run_job(self.extensions)
+        self.assertEqual(status['status'], 'completed')
+        # The worker died after the first download
+        job = DownloadJob.objects.get(download_id=download_id)
+        job.items[1]['state'] = 'pending'
+        job.save()
+        os.remove(os.path.join(self.tmp_dir, 'pub.other-3.0.0.vsix'))
+        os.remove(views.get_bundle_path(download_id))
+        self.marketplace.downloads.clear()
+        self.make_stale(download_id)
+
+        views.resume_unfinished_jobs()
+        self.assertEqual(self.resumed(), [download_id])
+        views.run_bulk_job(download_id)
+        status = views.get_download_status(download_id)
+        self.assertEqual(status['status'], 'completed')
+        self.assertIn('↻ Resuming download after a restart', status['details'])
+        self.assertIn('✓ pub.tool-1.0.0.vsix already exists (cached)', status['details'])
+        self.assertEqual(self.marketplace.downloads, ['pub.other-3.0.0.vsix'])
+        self.assertEqual([item['state'] for item in DownloadJob.objects.get(download_id=download_id).items],
+                         ['downloaded', 'downloaded'])
+        with zipfile.ZipFile(views.get_bundle_path(download_id)) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), ['pub.other-3.0.0.vsix', 'pub.tool-1.0.0.vsix'])
+
+    def test_cleanup_keeps_unfinished_jobs(self):
+        unfinished_id = self.start_job(self.extensions)
+        views.set_download_status(unfinished_id, 'downloading')
+        finished_id = self.start_job(self.extensions)
+        views.set_download_status(finished_id, 'completed')
+        for download_id in (unfinished_id, finished_id):
+            DownloadJob.objects.filter(download_id=download_id).update(
+                updated_at=timezone.now() - timedelta(seconds=views.BUNDLE_MAX_AGE + 1))
+        views.cleanup_download_jobs()
+        self.assertEqual(list(DownloadJob.objects.values_list('download_id', flat=True)), [unfinished_id])
+
+        # And the supervisor picks them up
+        views.resume_unfinished_jobs()
+        self.assertEqual(self.resumed(), [unfinished_id])
+
+
+class JobCancelTests(LocalStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('tool', 'other', 'third'):
+            self.marketplace.publish('pub', name, '1.0.0')
+        self.extensions = [{'publisher': 'pub', 'extension': name, 'version': '1.0.0'}
+                           for name in ('tool', 'other', 'third')]
+        # Check on every call instead of once per second
+        make_cancel_check = views.make_cancel_check
+        patcher = mock.patch.object(views, 'make_cancel_check', lambda download_id: make_cancel_check(download_id, 0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cancel(self, download_id):
+        return self.client.post(reverse('vscode_downloader:api_cancel_bulk_download', args=[download_id]))
+
+    def bundle_files(self, download_id):
+        return [name for name in os.listdir(views.get_bundle_dir()) if name.startswith(download_id)]
+
+    def test_cancel_during_download(self):
+        download_id = self.start_job(self.extensions)
+        request = self.marketplace.request
+
+        @contextmanager
+        def cancelling_request(method, url, **kwargs):
+            with request(method, url, **kwargs) as response:
+                if '/other/' in url:
+                    self.assertEqual(self.cancel(download_id).json(), {'download_id': download_id, 'cancelled': True})
+                yield response
+
+        with mock.patch.object(views, 'upstream_request', cancelling_request):
+            views.run_bulk_job(download_id)
+        status = views.get_download_status(download_id)
+        self.assertEqual(status['status'], 'cancelled')
+        self.assertEqual(status['details'][-1], '✗ Cancelled')
+        # The transfer stopped without leaving its partial file behind
+        self.assertEqual(self.marketplace.downloads, ['pub.tool-1.0.0.vsix', 'pub.other-1.0.0.vsix'])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['bundles', 'pub.tool-1.0.0.vsix', 'pub.tool-1.0.0.vsix.meta.json'])
+        self.assertEqual(self.bundle_files(download_id), [])
+
+    def test_cancel_during_packaging(self):
+        download_id = self.start_job(self.extensions, volume_size=1500)
+        add = BundleWriter.add
+        bundles = []
+
+        def cancelling_add(bundle, path, arcname):
+            add(bundle, path, arcname)
+            bundles.append(bundle)
+            if len(bundle.entries) + len(bundle.volumes) == 3:
+                self.cancel(download_id)
+
+        # Only BundleWriter.abort() cleans up here
+        with mock.patch.object(BundleWriter, 'add', cancelling_add), mock.patch.object(views, 'remove_bundle_files'):
+            views.run_bulk_job(download_id)
+        self.assertEqual(views.get_download_status(download_id)['status'], 'cancelled')
+        self.assertEqual([volume['name'] for volume in bundles[-1].volumes],
+                         [f'{download_id}.001.zip', f'{download_id}.002.zip'])
+        self.assertEqual(self.bundle_files(download_id), [])
+
+    @override_settings(VSCODE_DOWNLOADER_ABANDON_TIMEOUT=60)
+    def test_job_nobody_polls_is_abandoned(self):
+        long_ago = timezone.now() - timedelta(seconds=61)
+        polled_id = self.start_job(self.extensions)
+        DownloadJob.objects.filter(download_id=polled_id).update(created_at=long_ago)
+        self.client.get(reverse('vscode_downloader:api_bulk_download_status', args=[polled_id]))
+        views.run_bulk_job(polled_id)
+        self.assertEqual(views.get_download_status(polled_id)['status'], 'completed')
+
+        abandoned_id = self.start_job(self.extensions)
+        DownloadJob.objects.filter(download_id=abandoned_id).update(created_at=long_ago)
+        views.run_bulk_job(abandoned_id)
+        status = views.get_download_status(abandoned_id)
+        self.assertEqual(status['status'], 'cancelled')
+        self.assertEqual(status['current_file'], 'Abandoned, nobody polled the status any more')
+        self.assertIsNotNone(DownloadJob.objects.get(download_id=abandoned_id).cancelled_at)
+
+    def test_cancel_endpoint(self):
+        download_id = self.start_job(self.extensions)
+        views.set_download_status(download_id, 'downloading')
+        self.assertEqual(self.cancel(download_id).json(), {'download_id': download_id, 'cancelled': True})
+        # Already cancelled, or already finished
+        self.assertEqual(self.cancel(download_id).json(), {'download_id': download_id, 'cancelled': False})
+        finished_id, status = self.run_job(self.extensions)
+        self.assertEqual(status['status'], 'completed')
+        response = self.cancel(finished_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'download_id': finished_id, 'cancelled': False})
+
+        response = self.cancel('unknown')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'Download not found'})
+
+
+class GalleryTests(LocalStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        for target, replacement in [('get_tmp_dir', lambda: self.tmp_dir), ('_gallery_index', {'signature': None})]:
+            patcher = mock.patch.object(gallery, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.add_vsix('tool', '1.0.0')
+        self.add_vsix('tool', '1.1.0', files={'extension/README.md': '# Tool', 'extension/LICENSE.txt': 'MIT',
+                                              'extension/images/icon.png': 'png'},
+                      icon='images/icon.png', keywords=['linter'])
+        self.add_vsix('native', '1.0.0', 'linux-x64')
+        for platform in ('linux-x64', 'win32-x64'):
+            self.add_vsix('native', '2.0.0', platform)
+        self.add_vsix('other', '3.0.0')
+
+    def add_vsix(self, name, version, target_platform=None, **kwargs):
+        path = os.path.join(self.tmp_dir, VsixPackage('pub', name, version, target_platform).get_cache_name())
+        return make_vsix(path, 'pub', name, version, target_platform, **kwargs)
+
+    def query(self, *criteria, flags=0, **paging):
+        body = {'filters': [{'criteria': [{'filterType': filter_type, 'value': value} for filter_type, value in criteria],
+                             **paging}], 'flags': flags}
+        response = self.client.post(reverse('vscode_downloader:gallery_extension_query'), json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()['results'][0]
+        self.assertEqual(result['resultMetadata'][0]['metadataItems'][0]['name'], 'TotalCount')
+        return result['extensions'], result['resultMetadata'][0]['metadataItems'][0]['count']
+
+    def names(self, extensions):
+        return [extension['extensionName'] for extension in extensions]
+
+    def versions(self, extension):
+        return sorted((version['version'], version.get('targetPlatform', '')) for version in extension['versions'])
+
+    def test_query_by_name(self):
+        extensions, total = self.query((7, 'PUB.Tool'), (7, 'pub.missing'))
+        self.assertEqual((self.names(extensions), total), (['tool'], 1))
+        self.assertEqual(self.versions(extensions[0]), [('1.0.0', ''), ('1.1.0', '')])
+        files = {file['assetType']: file['source'] for file in extensions[0]['versions'][0]['files']}
+        self.assertTrue(files['Microsoft.VisualStudio.Services.VSIXPackage'].endswith(
+            '/gallery/assets/pub/tool/1.1.0/Microsoft.VisualStudio.Services.VSIXPackage'))
+        self.assertIn('Microsoft.VisualStudio.Services.Icons.Default', files)
+
+    def test_query_by_id(self):
+        extensions, total = self.query((4, gallery.gallery_uuid('pub.native')), (4, gallery.gallery_uuid('pub.missing')))
+        self.assertEqual((self.names(extensions), total), (['native'], 1))
+        self.assertEqual(extensions[0]['extensionId'], gallery.gallery_uuid('pub.native'))
+        self.assertEqual(self.versions(extensions[0]),
+                         [('1.0.0', 'linux-x64'), ('2.0.0', 'linux-x64'), ('2.0.0', 'win32-x64')])
+
+    def test_search_and_paging(self):
+        self.assertEqual(self.names(self.query((10, 'linter'))[0]), ['tool'])
+        self.assertEqual(self.names(self.query((10, 'the NATIVE extension'))[0]), ['native'])
+        pages = [self.query((10, 'extension'), pageSize=2, pageNumber=page_number) for page_number in (1, 2, 3)]
+        self.assertEqual([(self.names(extensions), total) for extensions, total in pages],
+                         [(['native', 'other'], 3), (['tool'], 3), ([], 3)])
+        # Without criteria every extension matches
+        self.assertEqual(self.query()[1], 3)
+
+    def test_latest_version_only(self):
+        extensions, _ = self.query((7, 'pub.tool'), (7, 'pub.native'), flags=0x200)
+        self.assertEqual([self.versions(extension) for extension in extensions],
+                         [[('1.1.0', '')], [('2.0.0', 'linux-x64'), ('2.0.0', 'win32-x64')]])
+        # Rendered records are cached separately for both flags
+        extensions, _ = self.query((7, 'pub.tool'))
+        self.assertEqual(len(extensions[0]['versions']), 2)
+
+        response = self.client.get(reverse('vscode_downloader:gallery_latest', args=['pub', 'native']))
+        self.assertEqual(self.versions(response.json()), [('2.0.0', 'linux-x64'), ('2.0.0', 'win32-x64')])
+
+    def test_find_gallery_version_by_target_platform(self):
+        def found(name, version, target_platform):
+            record = gallery.find_gallery_version('pub', name, version, target_platform)
+            return record and record['file']
+
+        self.assertEqual(found('native', '2.0.0', 'win32-x64'), 'pub.native-2.0.0@win32-x64.vsix')
+        self.assertIsNone(found('native', '2.0.0', 'darwin-arm64'))
+        self.assertIsNone(found('native', '1.0.0', 'win32-x64'))
+        # Universal versions serve every target, platform versions are picked for untargeted requests
+        self.assertEqual(found('tool', '1.1.0', 'darwin-arm64'), 'pub.tool-1.1.0.vsix')
+        self.assertEqual(found('native', '1.0.0', None), 'pub.native-1.0.0@linux-x64.vsix')
+        self.assertIsNone(found('tool', '9.9.9', None))
+        self.assertIsNone(found('missing', '1.0.0', None))
+
+    def asset(self, name, version, asset_type, **params):
+        return self.client.get(reverse('vscode_downloader:gallery_asset', args=['pub', name, version, asset_type]), params)
+
+    def test_assets(self):
+        # Members are matched regardless of case, and with any extension
+        self.assertEqual(self.asset('tool', '1.1.0', 'Microsoft.VisualStudio.Services.Content.Details').content, b'# Tool')
+        self.assertEqual(self.asset('tool', '1.1.0', 'Microsoft.VisualStudio.Services.Content.License').content, b'MIT')
+        response = self.asset('tool', '1.1.0', 'Microsoft.VisualStudio.Services.Icons.Default')
+        self.assertEqual((response.content, response['Content-Type']), (b'png', 'image/png'))
+        manifest = json.loads(self.asset('native', '2.0.0', 'Microsoft.VisualStudio.Code.Manifest',
+                                         targetPlatform='win32-x64').content)
+        self.assertEqual(manifest['version'], '2.0.0')
+
+        self.assertEqual(self.asset('tool', '1.0.0', 'Microsoft.VisualStudio.Services.Content.Details').status_code, 404)
+        self.assertEqual(self.asset('tool', '1.0.0', 'Microsoft.VisualStudio.Services.Icons.Default').status_code, 404)
+        self.assertEqual(self.asset('tool', '1.1.0', 'Unknown.Asset').status_code, 404)
+        self.assertEqual(self.asset('native', '2.0.0', 'Microsoft.VisualStudio.Code.Manifest',
+                                    targetPlatform='darwin-arm64').status_code, 404)
+
+        response = self.client.get(reverse('vscode_downloader:gallery_vspackage', args=['pub', 'native', '2.0.0']),
+                                   {'targetPlatform': 'linux-x64'})
+        with open(os.path.join(self.tmp_dir, 'pub.native-2.0.0@linux-x64.vsix'), 'rb') as f:
+            self.assertEqual(b''.join(response.streaming_content), f.read())
+
+    def test_index_follows_the_store(self):
+        root = reverse('vscode_downloader:gallery_root')
+        self.assertEqual(self.client.get(root).json(), {'extensions': 3})
+        self.add_vsix('new', '1.0.0')
+        with open(os.path.join(self.tmp_dir, 'pub.partial-1.0.0.vsix.0123.part'), 'w') as f:
+            f.write('partial')
+        self.assertEqual(self.client.get(root).json(), {'extensions': 4})
+        os.remove(os.path.join(self.tmp_dir, 'pub.tool-1.0.0.vsix'))
+        os.remove(os.path.join(self.tmp_dir, 'pub.tool-1.1.0.vsix'))
+        self.assertEqual(self.names(self.query()[0]), ['native', 'new', 'other'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ListExtensionsApiTests(SimpleTestCase):
+    def setUp(self):
+        self.catalog = [
+            {'publisher': {'publisherName': 'pub', 'displayName': 'Publisher'}, 'extensionName': f'ext{i}',
+             'displayName': f'Extension {i}', 'versions': [{'version': f'1.0.{i}'}],
+             'statistics': [{'statisticName': 'install', 'value': 1000 - i}]}
+            for i in range(5)
+        ]
+        self.queries = []
+        patcher = mock.patch.object(views, 'get_vscode_extensions', self.get_vscode_extensions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+    def get_vscode_extensions(self, search_query=None, first_page=1, page_size=100, sort_by=None, **kwargs):
+        self.queries.append((search_query, sort_by, page_size, first_page))
+        return self.catalog[(first_page - 1) * page_size:first_page * page_size]
+
+    def get(self, **params):
+        headers = {'HTTP_IF_NONE_MATCH': params.pop('if_none_match')} if 'if_none_match' in params else {}
+        return self.client.get(reverse('vscode_downloader:api_list_extensions'), params, **headers)
+
+    def test_cursor_keeps_the_query(self):
+        pages = []
+        response = self.get(search='ext', sort='rating', page_size=2)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            pages.append([extension['id'] for extension in data['extensions']])
+            if not data['next_cursor']:
+                break
+            # The other parameters are ignored once a cursor is given
+            response = self.get(cursor=data['next_cursor'], sort='installs', page_size=50)
+        self.assertEqual(pages, [['pub.ext0', 'pub.ext1'], ['pub.ext2', 'pub.ext3'], ['pub.ext4']])
+        self.assertEqual(self.queries, [('ext', 12, 2, 1), ('ext', 12, 2, 2), ('ext', 12, 2, 3)])
+
+    def test_bad_cursor_is_rejected(self):
+        cursor = self.get(page_size=2).json()['next_cursor']
+        for bad_cursor in (cursor[:-1] + ('A' if cursor[-1] != 'A' else 'B'), 'garbage',
+                           signing.dumps({'search': '', 'sort': 'installs', 'page_size': 2, 'page': 2}, salt='other')):
+            response = self.get(cursor=bad_cursor)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+        unknown_sort = signing.dumps({'search': '', 'sort': 'downloads', 'page_size': 2, 'page': 2}, salt='extension-listing')
+        response = self.get(cursor=unknown_sort)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unknown sort: downloads'})
+        self.assertEqual(self.get(sort='downloads').status_code, 400)
+
+    def test_matching_etag_gets_not_modified(self):
+        response = self.get(page_size=2)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        response = self.get(page_size=2, if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        # Other pages and the rendered variant have their own tags
+        self.assertEqual(self.get(page_size=3, if_none_match=etag).status_code, 200)
+        response = self.get(page_size=2, render='html', if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('html', response.json())
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_is_stable_across_cache_refills(self):
+        with mock.patch.object(signing.TimestampSigner, 'timestamp', return_value='1aaaaa'):
+            response = self.get(page_size=2)
+        # The entry expired and is fetched again, its cursor gets a new timestamp
+        cache.clear()
+        with mock.patch.object(signing.TimestampSigner, 'timestamp', return_value='1bbbbb'):
+            refilled = self.get(page_size=2, if_none_match=response['ETag'])
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual(refilled.status_code, 304)
+        self.assertEqual(refilled['ETag'], response['ETag'])
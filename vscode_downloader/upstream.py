@@ -0,0 +1,282 @@
+"""
+Every request to the marketplace and its CDN goes through here.
+
+A single scheduler per process combines a token bucket (requests per second)
+with an AIMD concurrency limit: each successful response raises the limit a
+little, a 429 or 5xx halves it. A Retry-After header pauses all upstream
+traffic, other throttled requests only back off themselves. Interactive
+lookups (the default) are always served before background traffic such as
+bulk jobs, and one slot is kept free for them.
+
+Worker processes share their Retry-After pauses and limit decreases through
+Django's cache, so a 429 seen by one worker slows down all of them. Each
+scheduler reads the shared state at most every SHARED_SYNC_INTERVAL seconds.
+
+Requests share one pooled session per process, so connections to the
+marketplace and the CDN are kept alive and reused instead of paying a new
+TCP and TLS handshake every time. Every request gets a connect and read
+timeout unless the caller passes its own.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from .profiling import span
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar('upstream_priority', default=INTERACTIVE)
+
+# Seconds between reads of the state shared with other worker processes
+SHARED_SYNC_INTERVAL = 1.0
+# A shared limit decrease is forgotten after this many seconds, by then the workers have recovered on their own
+SHARED_BACKOFF_TTL = 300
+SHARED_PAUSE_KEY = 'upstream-scheduler:paused-until'
+SHARED_BACKOFF_KEY = 'upstream-scheduler:backoff'
+
+
+@contextmanager
+def background_traffic():
+    """Mark upstream requests made in this block (and thread) as background traffic"""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_throttled(status_code):
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def parse_retry_after(response):
+    """Seconds to wait according to a Retry-After header, or None"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamScheduler:
+    def __init__(self, rate, burst, min_concurrency, max_concurrency, initial_concurrency, shared=None):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(initial_concurrency)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.active = 0
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.condition = threading.Condition()
+        # Cache shared with the other worker processes, or None
+        self.shared = shared
+        self.synced = 0.0
+        self.backoff_seen = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _slots(self, priority):
+        slots = int(self.limit)
+        if priority == BACKGROUND:
+            # Keep one slot for interactive lookups while the limit allows it
+            slots = max(1, slots - 1)
+        return slots
+
+    def _sync(self):
+        """Adopt pauses and limit decreases published by other processes"""
+        with self.condition:
+            now = time.monotonic()
+            if self.shared is None or now - self.synced < SHARED_SYNC_INTERVAL:
+                return
+            self.synced = now
+        try:
+            state = self.shared.get_many([SHARED_PAUSE_KEY, SHARED_BACKOFF_KEY])
+        except Exception as e:
+            # The shared state is an optimisation, never let it stop upstream traffic
+            print(f'Could not read the shared upstream state: {str(e)}')
+            return
+        with self.condition:
+            paused_until = state.get(SHARED_PAUSE_KEY)
+            if paused_until:
+                # Stored as wall clock time, other processes have their own monotonic clocks
+                self.paused_until = max(self.paused_until, time.monotonic() + paused_until - time.time())
+            backoff = state.get(SHARED_BACKOFF_KEY)
+            if backoff and backoff['at'] > self.backoff_seen:
+                self.backoff_seen = backoff['at']
+                self.limit = max(self.min_concurrency, min(self.limit, backoff['limit']))
+
+    def _publish(self, limit, retry_after):
+        """Share a limit decrease and a Retry-After pause with the other processes"""
+        if self.shared is None:
+            return
+        now = time.time()
+        try:
+            self.shared.set(SHARED_BACKOFF_KEY, {'limit': limit, 'at': now}, SHARED_BACKOFF_TTL)
+            if retry_after:
+                paused_until = max(self.shared.get(SHARED_PAUSE_KEY) or 0, now + retry_after)
+                self.shared.set(SHARED_PAUSE_KEY, paused_until, int(paused_until - now) + 1)
+        except Exception as e:
+            print(f'Could not share the upstream state: {str(e)}')
+            return
+        with self.condition:
+            self.backoff_seen = max(self.backoff_seen, now)
+
+    def acquire(self, priority=INTERACTIVE):
+        self._sync()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    yield_to_interactive = priority == BACKGROUND and self.waiting[INTERACTIVE] > 0
+                    if (not yield_to_interactive and now >= self.paused_until
+                            and self.active < self._slots(priority) and self.tokens >= 1):
+                        self.tokens -= 1
+                        self.active += 1
+                        return
+                    timeout = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.01)
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting[priority] -= 1
+
+    def release(self, status_code=None, retry_after=None):
+        """Give the slot back and adapt the concurrency limit to the response"""
+        with self.condition:
+            self.active -= 1
+            throttled = is_throttled(status_code)
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            limit = self.limit
+            self.condition.notify_all()
+        if throttled:
+            self._publish(limit, retry_after)
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                'limit': round(self.limit, 2),
+                'active': self.active,
+                'waiting': dict(self.waiting),
+                'paused_for': max(round(self.paused_until - time.monotonic(), 2), 0),
+            }
+
+
+scheduler = UpstreamScheduler(
+    rate=settings.VSCODE_DOWNLOADER_UPSTREAM_RATE,
+    burst=settings.VSCODE_DOWNLOADER_UPSTREAM_BURST,
+    min_concurrency=1,
+    max_concurrency=settings.VSCODE_DOWNLOADER_UPSTREAM_MAX_CONCURRENCY,
+    initial_concurrency=min(4, settings.VSCODE_DOWNLOADER_UPSTREAM_MAX_CONCURRENCY),
+    shared=cache,
+)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The process wide pooled session used for all upstream traffic"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # One pool per host, each keeping enough connections alive for the concurrency limit.
+                # Retries are handled by upstream_request, not urllib3.
+                adapter = HTTPAdapter(
+                    pool_connections=settings.VSCODE_DOWNLOADER_UPSTREAM_POOL_HOSTS,
+                    pool_maxsize=settings.VSCODE_DOWNLOADER_UPSTREAM_POOL_SIZE,
+                    max_retries=0,
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = 'offline-vscode-downloader'
+                _session = session
+    return _session
+
+
+@contextmanager
+def upstream_request(method, url, session=None, priority=None, retries=3, **kwargs):
+    """
+    Send a request through the scheduler. The slot is held until the block
+    exits, so streamed downloads count against the concurrency limit for the
+    whole transfer. Throttled responses are retried after backing off.
+    """
+    priority = _priority.get() if priority is None else priority
+    kwargs.setdefault('timeout', (
+        settings.VSCODE_DOWNLOADER_UPSTREAM_CONNECT_TIMEOUT,
+        settings.VSCODE_DOWNLOADER_UPSTREAM_READ_TIMEOUT,
+    ))
+    if settings.VSCODE_DOWNLOADER_UPSTREAM_PROXY:
+        # Passed per request, requests prefers HTTP(S)_PROXY from the environment over session.proxies
+        kwargs.setdefault('proxies', {
+            'http': settings.VSCODE_DOWNLOADER_UPSTREAM_PROXY,
+            'https': settings.VSCODE_DOWNLOADER_UPSTREAM_PROXY,
+        })
+    for attempt in range(retries + 1):
+        with span('upstream.wait'):
+            scheduler.acquire(priority)
+        try:
+            with span('upstream.request', method=method, url=url, attempt=attempt):
+                response = (session or get_session()).request(method, url, **kwargs)
+        except requests.RequestException:
+            scheduler.release(None)
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt / 2)
+            continue
+
+        retry_after = parse_retry_after(response)
+        if is_throttled(response.status_code) and attempt < retries:
+            # Only an explicit Retry-After pauses all traffic, a plain 5xx from one URL
+            # just halves the limit and backs off this request
+            scheduler.release(response.status_code, retry_after)
+            response.close()
+            if not retry_after:
+                time.sleep(2 ** attempt / 2)
+            continue
+
+        try:
+            yield response
+        finally:
+            scheduler.release(response.status_code, retry_after)
+            response.close()
+        return
+
+
+def upstream_get(url, **kwargs):
+    with upstream_request('GET', url, **kwargs) as response:
+        # Read the body while the slot is held
+        response.content
+        return response
+
+
+def upstream_post(url, **kwargs):
+    with upstream_request('POST', url, **kwargs) as response:
+        response.content
+        return response
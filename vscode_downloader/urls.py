@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import gallery, views
 
 app_name = 'vscode_downloader'
 
@@ -9,9 +9,21 @@ urlpatterns = [
     path('api/bulk-download/start/', views.api_start_bulk_download, name='api_start_bulk_download'),
     path('api/bulk-download/status/<str:download_id>/', views.api_download_status, name='api_bulk_download_status'),
     path('api/bulk-download/zip/<str:download_id>/', views.api_get_bulk_download_zip, name='api_get_bulk_download_zip'),
+    path('api/bulk-download/cancel/<str:download_id>/', views.api_cancel_download, name='api_cancel_bulk_download'),
+    path('api/download-trace/<str:download_id>/', views.api_download_trace, name='api_download_trace'),
+    path('api/extensions/', views.api_list_extensions, name='api_list_extensions'),
     path('api/extensions/<str:extension_id>/', views.api_extension_details, name='api_extension_details'),
     path('api/extensions/<str:extension_id>/compatible/<str:vscode_target_version>/', 
          views.api_get_compatible_version, name='api_get_compatible_version'),
     path('api/extensions/<str:extension_id>/download/', views.api_start_extension_download, name='api_start_extension_download'),
+    path('api/extensions/<str:extension_id>/vsix/<str:version>/', views.api_get_vsix, name='api_get_vsix'),
     path('api/download/status/<str:download_id>/', views.api_download_status, name='api_download_status'),
+    # Local marketplace for VS Code: set extensionsGallery.serviceUrl to .../vscode_downloader/gallery
+    path('gallery', gallery.gallery_root, name='gallery_root'),
+    path('gallery/extensionquery', gallery.gallery_extension_query, name='gallery_extension_query'),
+    path('gallery/publishers/<str:publisher>/vsextensions/<str:name>/<str:version>/vspackage',
+         gallery.gallery_vspackage, name='gallery_vspackage'),
+    path('gallery/assets/<str:publisher>/<str:name>/<str:version>/<str:asset_type>',
+         gallery.gallery_asset, name='gallery_asset'),
+    path('gallery/vscode/<str:publisher>/<str:name>/latest', gallery.gallery_latest, name='gallery_latest'),
 ] 
\ No newline at end of file
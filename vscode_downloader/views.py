@@ -1,47 +1,181 @@
 from django.shortcuts import render
-from django.http import HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+from django.core import signing
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.text import compress_string
 import json
 import zipfile
 import requests
 import semver
-from io import BytesIO
-from .models import VsixPackage
+from urllib.parse import quote
+from xml.etree import ElementTree
+from .bundles import BundleWriter, parse_size
+from .models import DownloadJob, VsixPackage
+from .profiling import cleanup_traces, current_trace, finish_trace, fold, load_trace, profile_mode, span, start_trace
+from .upstream import background_traffic, upstream_get, upstream_post, upstream_request
+try:
+    import brotli
+except ImportError:  # optional, gzip is used without it
+    brotli = None
 from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
 import uuid
+import hashlib
 import threading
 import os
+import socket
+import time
+from datetime import timedelta
+
+# Finished bundles are kept on disk this long (seconds)
+BUNDLE_MAX_AGE = 3600
+# Running bulk jobs touch their record this often (seconds), and are
+# considered abandoned by a dead worker when untouched for JOB_LEASE
+JOB_HEARTBEAT_INTERVAL = 15
+JOB_LEASE = 60
+# A job that keeps taking its worker down is given up after this many resumes
+JOB_MAX_RESUMES = 3
+UNFINISHED_STATUSES = ('starting', 'preparing', 'resolving', 'downloading', 'packaging')
+# Minimum seconds between progress writes of a single extension download
+PROGRESS_INTERVAL = 0.5
+# Catalog listing sort keys, mapped to the marketplace's SortBy values (sorted descending)
+LISTING_SORTS = {
+    'installs': 4,
+    'rating': 12,
+    'updated': 1,
+}
+LISTING_MAX_PAGE_SIZE = 100
 
 def browse_extensions(request):
     # Get query parameters with defaults
-    page_size = int(request.GET.get('page_size', 20))
+    page_size = min(int(request.GET.get('page_size', 20)), LISTING_MAX_PAGE_SIZE)
+    # Further pages are loaded from api_list_extensions while scrolling
     max_page = int(request.GET.get('max_page', 1))
     search_query = request.GET.get('search', '')
+    sort = request.GET.get('sort', 'installs')
+    if sort not in LISTING_SORTS:
+        sort = 'installs'
     
-    # Get extensions using the existing method
     extensions_list = []
+    next_cursor = None
     try:
-        for extension in get_vscode_extensions(search_query=search_query, max_page=max_page, page_size=page_size):
-            ext_data = {
-                'displayName': extension.get('displayName', ''),
-                'publisher': extension.get('publisher', {}).get('publisherName', ''),
-                'publisherDisplayName': extension.get('publisher', {}).get('displayName', ''),
-                'extensionName': extension.get('extensionName', ''),
-                'shortDescription': extension.get('shortDescription', ''),
-                'version': extension.get('versions', [{}])[0].get('version', ''),
-            }
-            extensions_list.append(ext_data)
+        for page in range(1, max_page + 1):
+            listing = get_extension_listing(search_query, sort, page_size, page)
+            extensions_list.extend(listing['extensions'])
+            next_cursor = listing['next_cursor']
+            if not next_cursor:
+                break
     except Exception as e:
         return render(request, 'vscode_downloader/browse_extensions.html', {'error': str(e)})
 
     return render(request, 'vscode_downloader/browse_extensions.html', {
         'extensions': extensions_list,
+        'next_cursor': next_cursor,
         'search_query': search_query,
+        'sort': sort,
         'page_size': page_size,
         'max_page': max_page,
     })
 
+def summarize_extension(extension):
+    """The fields of a marketplace result shown in the catalog listing"""
+    statistics = {stat.get('statisticName'): stat.get('value') for stat in extension.get('statistics', [])}
+    return {
+        'id': f"{extension.get('publisher', {}).get('publisherName', '')}.{extension.get('extensionName', '')}",
+        'displayName': extension.get('displayName', ''),
+        'publisher': extension.get('publisher', {}).get('publisherName', ''),
+        'publisherDisplayName': extension.get('publisher', {}).get('displayName', ''),
+        'extensionName': extension.get('extensionName', ''),
+        'shortDescription': extension.get('shortDescription', ''),
+        'version': (extension.get('versions') or [{}])[0].get('version', ''),
+        'lastUpdated': extension.get('lastUpdated', ''),
+        'installs': int(statistics.get('install') or 0),
+        'rating': round(statistics.get('averagerating') or 0, 2),
+        'ratingCount': int(statistics.get('ratingcount') or 0),
+    }
+
+def get_extension_listing(search_query, sort, page_size, page):
+    """
+    One page of the catalog, cached for VSCODE_DOWNLOADER_LISTING_TTL seconds.
+    Only the latest version and the statistics of each extension are fetched.
+    Returns a dict with ``extensions``, ``next_cursor`` and the page's ``etag``.
+    """
+    query = {'search': search_query, 'sort': sort, 'page_size': page_size, 'page': page}
+    cache_key = 'extension-listing:' + hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+    listing = cache.get(cache_key)
+    if listing is not None:
+        return listing
+
+    extensions = [
+        summarize_extension(extension)
+        for extension in get_vscode_extensions(
+            search_query=search_query, max_page=1, first_page=page, page_size=page_size,
+            sort_by=LISTING_SORTS[sort], sort_order=2,
+            include_files=False, include_category_and_tags=False, include_shared_accounts=False,
+            include_version_properties=False, include_installation_targets=False, include_asset_uri=False,
+            include_latest_version_only=True, include_name_conflict_info=False,
+        )
+    ]
+    next_cursor = None
+    if len(extensions) == page_size:
+        # The cursor carries the whole query, so later pages keep the same search, sort and size
+        next_cursor = signing.dumps(dict(query, page=page + 1), salt='extension-listing')
+    # Not hashed over next_cursor, its signature is timestamped and would change the ETag on every refill
+    etag = hashlib.sha256(json.dumps([query, extensions], sort_keys=True).encode()).hexdigest()[:32]
+    listing = {'extensions': extensions, 'next_cursor': next_cursor, 'etag': etag}
+    cache.set(cache_key, listing, settings.VSCODE_DOWNLOADER_LISTING_TTL)
+    return listing
+
+def api_list_extensions(request):
+    """
+    Page through the catalog:
+
+    - ``search``, ``sort`` (installs, rating or updated) and ``page_size`` for the first page
+    - ``cursor``: ``next_cursor`` of the previous page, the other parameters are then ignored
+    - ``render=html``: also return the page as rendered extension cards in ``html``
+
+    Pages are cached briefly and carry an ETag, so revisiting one costs a 304.
+    """
+    try:
+        if request.GET.get('cursor'):
+            try:
+                query = signing.loads(request.GET['cursor'], salt='extension-listing')
+            except signing.BadSignature:
+                return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        else:
+            query = {
+                'search': request.GET.get('search', ''),
+                'sort': request.GET.get('sort', 'installs'),
+                'page_size': min(max(int(request.GET.get('page_size', 20)), 1), LISTING_MAX_PAGE_SIZE),
+                'page': 1,
+            }
+        if query['sort'] not in LISTING_SORTS:
+            return JsonResponse({'error': f"Unknown sort: {query['sort']}"}, status=400)
+        render_html = request.GET.get('render') == 'html'
+
+        listing = get_extension_listing(query['search'], query['sort'], query['page_size'], query['page'])
+        # Weak, the body is compressed differently depending on Accept-Encoding
+        etag = f'W/"{listing["etag"]}{"-html" if render_html else ""}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            data = {'extensions': listing['extensions'], 'next_cursor': listing['next_cursor']}
+            if render_html:
+                data['html'] = render_to_string('vscode_downloader/extension_list.html', {'extensions': listing['extensions']})
+            response = compressed_json_response(request, data)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=settings.VSCODE_DOWNLOADER_LISTING_TTL)
+        return response
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 def get_extension_details(request):
     extension_id = request.GET.get('extension_id', '')
     if not extension_id:
@@ -66,7 +200,7 @@ def get_extension_details(request):
             if manifest_file and manifest_file.get('source'):
                 try:
                     # Fetch the manifest content
-                    manifest_response = requests.get(manifest_file['source'])
+                    manifest_response = upstream_get(manifest_file['source'])
                     manifest_response.raise_for_status()  # Raise exception for bad status codes
                     
                     manifest = manifest_response.json()
@@ -103,10 +237,8 @@ def get_extension_details(request):
 def get_vscode_extensions(search_query=None, extensionId=None, max_page=10000, page_size=100,
                           include_versions=True, include_files=True, include_category_and_tags=True, include_shared_accounts=True, include_version_properties=True,
                           exclude_non_validated=False, include_installation_targets=True, include_asset_uri=True, include_statistics=True,
-                          include_latest_version_only=False, unpublished=False, include_name_conflict_info=True, api_version='7.2-preview.1', session=None):
-    if not session:
-        session = requests.session()
-
+                          include_latest_version_only=False, unpublished=False, include_name_conflict_info=True, api_version='7.2-preview.1', session=None,
+                          first_page=1, sort_by=0, sort_order=0):
     headers = {'Accept': f'application/json; charset=utf-8; api-version={api_version}'}
 
     flags = 0
@@ -149,7 +281,7 @@ def get_vscode_extensions(search_query=None, extensionId=None, max_page=10000, p
     if include_name_conflict_info:
         flags |= 0x8000
 
-    for page in range(1, max_page + 1):
+    for page in range(first_page, first_page + max_page):
         # Create base criteria list
         criteria = [
             {
@@ -177,15 +309,15 @@ def get_vscode_extensions(search_query=None, extensionId=None, max_page=10000, p
                     "criteria": criteria,
                     "pageNumber": page,
                     "pageSize": page_size,
-                    "sortBy": 0,
-                    "sortOrder": 0
+                    "sortBy": sort_by,
+                    "sortOrder": sort_order
                 }
             ],
             "assetTypes": [],
             "flags": flags
         }
 
-        r = session.post('https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery', json=body, headers=headers)
+        r = upstream_post('https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery', json=body, headers=headers, session=session)
         r.raise_for_status()
         response = r.json()
 
@@ -198,88 +330,101 @@ def get_vscode_extensions(search_query=None, extensionId=None, max_page=10000, p
 
 
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def api_download_extensions(request):
-    try:
-        data = json.loads(request.body)
-        extensions = data.get('extensions', [])
-
-        print(f'Downloading {len(extensions)} extensions')
-
-        zip_buffer = BytesIO()
-            
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for extension_data in extensions:
-                # Get extension details to find compatible version
-                print(f'Getting extension details for {extension_data}')
-                publisher = extension_data['publisher']
-                extension = extension_data['extension']
-                version = extension_data['version']
-                target_platform = extension_data.get('targetPlatform')
-                
-                vsix = VsixPackage(
-                    publisher=publisher,
-                    extension=extension,
-                    version=version,
-                    target=target_platform
-                )
+def accepted_encodings(accept_encoding):
+    """Content codings of an Accept-Encoding header mapped to their q values"""
+    encodings = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encodings[coding] = quality
+    return encodings
 
-                print(f'Downloading {vsix.get_vsix_name()}')
-                
-                # Create absolute path for temp directory
-                tmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
-                os.makedirs(tmp_dir, exist_ok=True)
-                
-                # Use absolute path for temp file
-                temp_path = os.path.join(tmp_dir, vsix.get_vsix_name())
-
-                # Check if file exists in tmp directory
-                if not os.path.exists(temp_path):
-                    # Download if not exists
-                    response = requests.get(vsix.get_url())
-                    response.raise_for_status()
-                    
-                    # Save to tmp directory
-                    os.makedirs(tmp_dir, exist_ok=True)
-                    with open(temp_path, 'wb') as f:
-                        f.write(response.content)
+def compressed_json_response(request, data, status=200):
+    """
+    JsonResponse compressed with brotli (when the optional brotli package is
+    installed) or gzip, depending on the client's Accept-Encoding.
+    """
+    response = JsonResponse(data, status=status)
+    encodings = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(response.content) < 200:
+        return response
 
+    def accepts(coding):
+        return encodings.get(coding, encodings.get('*', 0)) > 0
 
-                print(f'Adding {vsix.get_vsix_name()} to zip file')
-                # Add to zip file using arcname to control the name in the zip
-                zip_file.write(temp_path, arcname=vsix.get_vsix_name())
-        
-        zip_buffer.seek(0)
-        response = HttpResponse(zip_buffer.getvalue(), content_type='application/octet-stream')
-        response['Content-Disposition'] = 'attachment; filename="vscode_extensions.zip"'
-        response["Content-Length"] = str(len(zip_data))
-        response["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response["Pragma"] = "no-cache"
-        response["Expires"] = "0"
-        response["X-Content-Type-Options"] = "nosniff"
-        response["Accept-Ranges"] = "bytes"
-        response["X-Download-Options"] = "noopen"
-        response["X-Permitted-Cross-Domain-Policies"] = "none"
-        # Add headers to make it look like a direct file download
-        response["Content-Transfer-Encoding"] = "binary"
-        response["Content-Description"] = "File Transfer"
-        return response
-        
-    except Exception as e:
-        print(f'Error downloading extensions: {str(e)}')
-        return HttpResponse(str(e), status=500)
+    if brotli is not None and accepts('br'):
+        response.content = brotli.compress(response.content)
+        response['Content-Encoding'] = 'br'
+    elif accepts('gzip'):
+        response.content = compress_string(response.content)
+        response['Content-Encoding'] = 'gzip'
+    return response
 
 def api_extension_details(request, extension_id):
+    """
+    Extension details with optional projection and version paging:
+
+    - ``fields``: comma separated top level keys to return (``version_info`` included)
+    - ``version_fields``: comma separated keys to keep on each entry of ``versions``
+    - ``versions``: number of versions (newest first) to return per page
+    - ``cursor``: ``next_cursor`` of the previous page
+    """
     try:
-        extension_details = list(get_vscode_extensions(extensionId=extension_id, max_page=1))
+        fields = [field for field in request.GET.get('fields', '').split(',') if field]
+        version_fields = [field for field in request.GET.get('version_fields', '').split(',') if field]
+        page_size = request.GET.get('versions')
+        if page_size:
+            try:
+                page_size = int(page_size)
+            except ValueError:
+                page_size = 0
+            if page_size < 1:
+                return JsonResponse({'error': f"Invalid versions: {request.GET['versions']}"}, status=400)
+        offset = 0
+        if request.GET.get('cursor'):
+            try:
+                cursor = signing.loads(request.GET['cursor'], salt='extension-versions')
+            except signing.BadSignature:
+                return JsonResponse({'error': 'Invalid cursor'}, status=400)
+            # A cursor only continues the listing of the extension it was issued for
+            if cursor.get('extension_id') != extension_id.lower():
+                return JsonResponse({'error': 'Invalid cursor'}, status=400)
+            offset = cursor['offset']
+
+        extension_details = list(get_vscode_extensions(
+            extensionId=extension_id, max_page=1,
+            include_statistics=not fields or 'statistics' in fields
+        ))
         if not extension_details:
             return JsonResponse({'error': 'Extension not found'}, status=404)
         
         extension = extension_details[0]
         version_info = []
+
+        # Only the requested window of versions is inspected, which also limits manifest fetches
+        versions = extension.get('versions', [])
+        next_cursor = None
+        if page_size:
+            end = offset + page_size
+            if end < len(versions):
+                next_cursor = signing.dumps({'extension_id': extension_id.lower(), 'offset': end}, salt='extension-versions')
+            versions = versions[offset:end]
+        elif offset:
+            versions = versions[offset:]
+        extension['versions'] = versions
         
-        for version in extension.get('versions', []):
+        for version in versions:
 
             properties = {prop.get('key'): prop.get('value') for prop in version.get('properties', {})}
 
@@ -302,7 +447,7 @@ def api_extension_details(request, extension_id):
             
             if manifest_file and manifest_file.get('source'):
                 try:
-                    manifest_response = requests.get(manifest_file['source'])
+                    manifest_response = upstream_get(manifest_file['source'])
                     manifest_response.raise_for_status()
                     
                     manifest = manifest_response.json()
@@ -323,7 +468,16 @@ def api_extension_details(request, extension_id):
                 })
         
         extension['version_info'] = version_info
-        return JsonResponse(extension)
+        if version_fields:
+            extension['versions'] = [
+                {key: value for key, value in version.items() if key in version_fields}
+                for version in versions
+            ]
+        if fields:
+            extension = {key: value for key, value in extension.items() if key in fields}
+        if page_size or offset:
+            extension['next_cursor'] = next_cursor
+        return compressed_json_response(request, extension)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -332,31 +486,88 @@ def api_compatible_version(extension_id, vscode_target_version, target_platform)
     Get the highest compatible version of an extension for a specific VSCode version.
     """
     try:
-        extension_details = list(get_vscode_extensions(extensionId=extension_id, max_page=1))
-        if not extension_details:
-            return None
+        return resolve_extension_platforms(extension_id, vscode_target_version, [target_platform], use_cache=True)[target_platform]
+    except Exception as e:
+        return None
+
+def compatible_version_cache_key(extension_id, vscode_target_version, target_platform):
+    return f'compatible_version_{extension_id.lower()}_{vscode_target_version}_{target_platform}'
+
+def cache_compatible_version(extension_id, vscode_target_version, target_platform, result):
+    if result:
+        cache.set(compatible_version_cache_key(extension_id, vscode_target_version, target_platform), result,
+                  timeout=settings.VSCODE_DOWNLOADER_RESOLUTION_TTL)
+
+def find_compatible_version(extension, vscode_target_version, target_platform, manifest_cache=None):
+    """
+    Pick the highest version of an already fetched marketplace extension that is
+    compatible with the given VSCode version and platform.
+
+    ``manifest_cache`` can be shared between calls for the same extension so that
+    resolving several platforms fetches each version's manifest only once.
+    """
+    if manifest_cache is None:
+        manifest_cache = {}
+    publisher = extension.get('publisher', {}).get('publisherName')
+    extension_name = extension.get('extensionName')
+
+    # Sort versions by version number (newest first), a platform package before a universal one of the same version
+    versions = sorted(
+        extension.get('versions', []),
+        key=lambda x: (x.get('version', '0.0.0'), x.get('targetPlatform') is not None),
+        reverse=True
+    )
+
+    for version in versions:
         
-        extension = extension_details[0]
-        # Sort versions by version number (newest first)
-        versions = sorted(
-            extension.get('versions', []),
-            key=lambda x: x.get('version', '0.0.0'),
-            reverse=True
-        )
+        if version.get('targetPlatform') is not None and version.get('targetPlatform') != target_platform:
+            continue
 
-        for version in versions:
-            
-            if version.get('targetPlatform') is not None and version.get('targetPlatform') != target_platform:
-                continue
+        properties = {prop.get('key'): prop.get('value') for prop in version.get('properties', {})}
 
-            properties = {prop.get('key'): prop.get('value') for prop in version.get('properties', {})}
+        if properties.get('Microsoft.VisualStudio.Code.PreRelease'):
+            continue
 
-            if properties.get('Microsoft.VisualStudio.Code.PreRelease'):
+        if properties.get('Microsoft.VisualStudio.Code.Engine'):
+            min_vscode = properties.get('Microsoft.VisualStudio.Code.Engine')
+            min_version = min_vscode.replace('^', '').replace('>=', '')
+            if semver.compare(vscode_target_version, min_version) >= 0:
+                result = {
+                    'version': version.get('version'),
+                    'vscode_constraint': min_version
+                }
+                if version.get('targetPlatform'):
+                    result['targetPlatform'] = version.get('targetPlatform')
+                return result
+            else:
                 continue
 
-            if properties.get('Microsoft.VisualStudio.Code.Engine'):
-                min_vscode = properties.get('Microsoft.VisualStudio.Code.Engine')
+        manifest_file = next(
+            (file for file in version.get('files', [])
+             if file.get('assetType') == 'Microsoft.VisualStudio.Code.Manifest'),
+            None
+        )
+        
+        if manifest_file and manifest_file.get('source'):
+            try:
+                source = manifest_file['source']
+                if source not in manifest_cache and publisher and extension_name:
+                    # A VSIX we already hold answers this without a network round trip
+                    local_manifest = get_local_manifest(
+                        publisher, extension_name, version.get('version'),
+                        [version.get('targetPlatform'), target_platform, None]
+                    )
+                    if local_manifest is not None:
+                        manifest_cache[source] = local_manifest
+                if source not in manifest_cache:
+                    manifest_response = upstream_get(source)
+                    manifest_response.raise_for_status()
+                    manifest_cache[source] = manifest_response.json()
+                
+                manifest = manifest_cache[source]
+                min_vscode = manifest.get('engines', {}).get('vscode', 'N/A')
                 min_version = min_vscode.replace('^', '').replace('>=', '')
+
                 if semver.compare(vscode_target_version, min_version) >= 0:
                     result = {
                         'version': version.get('version'),
@@ -365,38 +576,64 @@ def api_compatible_version(extension_id, vscode_target_version, target_platform)
                     if version.get('targetPlatform'):
                         result['targetPlatform'] = version.get('targetPlatform')
                     return result
-                else:
-                    continue
+            except:
+                continue
+    
+    return None
 
-            manifest_file = next(
-                (file for file in version.get('files', [])
-                 if file.get('assetType') == 'Microsoft.VisualStudio.Code.Manifest'),
-                None
-            )
-            
-            if manifest_file and manifest_file.get('source'):
-                try:
-                    manifest_response = requests.get(manifest_file['source'])
-                    manifest_response.raise_for_status()
-                    
-                    manifest = manifest_response.json()
-                    min_vscode = manifest.get('engines', {}).get('vscode', 'N/A')
-                    min_version = min_vscode.replace('^', '').replace('>=', '')
-
-                    if semver.compare(vscode_target_version, min_version) >= 0:
-                        result = {
-                            'version': version.get('version'),
-                            'vscode_constraint': min_version
-                        }
-                        if version.get('targetPlatform'):
-                            result['targetPlatform'] = version.get('targetPlatform')
-                        return result
-                except:
-                    continue
-        
-        return None
-    except Exception as e:
-        return None
+def resolve_extension_platforms(extension_id, vscode_target_version, target_platforms, use_cache=False):
+    """
+    Resolve the compatible version of one extension for several platforms using a
+    single marketplace query. Returns a dict of platform -> result (or None).
+
+    With ``use_cache`` previously resolved (or pre-warmed) results are reused and
+    new ones are stored; the marketplace is only queried for the missing platforms.
+    """
+    results = {}
+    if use_cache:
+        for platform in target_platforms:
+            cached = cache.get(compatible_version_cache_key(extension_id, vscode_target_version, platform))
+            if cached:
+                results[platform] = cached
+
+    missing = [platform for platform in target_platforms if platform not in results]
+    if not missing:
+        return results
+
+    extension_details = list(get_vscode_extensions(extensionId=extension_id, max_page=1))
+    if not extension_details:
+        results.update({platform: None for platform in missing})
+        return results
+
+    manifest_cache = {}
+    for platform in missing:
+        results[platform] = find_compatible_version(extension_details[0], vscode_target_version, platform, manifest_cache)
+        if use_cache:
+            cache_compatible_version(extension_id, vscode_target_version, platform, results[platform])
+    return results
+
+def resolve_pinned_version(extension_id, version, target_platforms):
+    """
+    Resolve a pinned version of one extension for several platforms from its
+    marketplace record: the version's package for a platform when it has one,
+    else its universal package, returned without a target so all platforms
+    share one artifact. Returns a dict of platform -> result (or None).
+    """
+    extension_details = list(get_vscode_extensions(extensionId=extension_id, max_page=1))
+    published = {
+        record.get('targetPlatform')
+        for record in (extension_details[0].get('versions', []) if extension_details else [])
+        if record.get('version') == version
+    }
+    results = {}
+    for platform in target_platforms:
+        if platform in published:
+            results[platform] = {'version': version, 'targetPlatform': platform}
+        elif None in published:
+            results[platform] = {'version': version}
+        else:
+            results[platform] = None
+    return results
 
 def api_get_compatible_version(request, extension_id, vscode_target_version):
     """API endpoint to get compatible version"""
@@ -414,23 +651,188 @@ def api_get_compatible_version(request, extension_id, vscode_target_version):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def get_tmp_dir():
+    """Directory holding downloaded VSIX files, shared by every download path"""
+    tmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tmp_dir
+
+def download_vsix(vsix, tmp_dir=None, on_progress=None):
+    """
+    Download a VSIX into the temp directory unless it is already there.
+    Returns a tuple of (path, cached). The file is written under a temporary
+    name first so concurrent downloads never expose a partial package.
+    ``on_progress(downloaded, total)`` is called after every chunk.
+
+    Universal packages are stored once under their plain VSIX name, whichever
+    target they were requested for, so use the returned path rather than
+    ``vsix.get_cache_name()``. A targeted request only reuses that file once
+    the marketplace answered the same target with it, see mark_universal().
+    """
+    tmp_dir = tmp_dir or get_tmp_dir()
+    temp_path = os.path.join(tmp_dir, vsix.get_cache_name())
+    if os.path.exists(temp_path):
+        return temp_path, True
+    universal_path = os.path.join(tmp_dir, vsix.get_vsix_name())
+    if vsix.target and os.path.exists(get_universal_marker_path(vsix, tmp_dir)) and is_universal_vsix(universal_path):
+        return universal_path, True
+
+    part_path = f'{temp_path}.{uuid.uuid4().hex}.part'
+    try:
+        # The upstream slot is held for the whole transfer
+        with upstream_request('GET', vsix.get_url(), stream=True) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get('content-length', 0))
+            downloaded = 0
+            # Disk writes are accounted separately from the transfer when the job is profiled
+            trace = current_trace()
+            with span('upstream.transfer', size=total_size), open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if trace:
+                        write_started = time.perf_counter()
+                        f.write(chunk)
+                        trace.add('disk.write', time.perf_counter() - write_started)
+                    else:
+                        f.write(chunk)
+                    downloaded += len(chunk)
+                    if on_progress:
+                        on_progress(downloaded, total_size)
+        universal = False
+        if vsix.target:
+            try:
+                # The marketplace answers a targeted request with the universal package when there is no other
+                universal = read_vsix_identity(part_path)[0] is None
+            except (zipfile.BadZipFile, ElementTree.ParseError):
+                pass
+        if universal:
+            temp_path = universal_path
+        os.replace(part_path, temp_path)
+        # The file may replace an older one (e.g. a platform package cached under the plain name)
+        if os.path.exists(f'{temp_path}.meta.json'):
+            os.remove(f'{temp_path}.meta.json')
+        if universal:
+            mark_universal(vsix, tmp_dir)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    try:
+        with span('vsix.metadata'):
+            get_vsix_metadata(temp_path)
+    except (zipfile.BadZipFile, KeyError, json.JSONDecodeError) as e:
+        print(f'Could not read metadata of {vsix.get_vsix_name()}: {str(e)}')
+    return temp_path, False
+
+def get_universal_marker_path(vsix, tmp_dir=None):
+    return os.path.join(tmp_dir or get_tmp_dir(), f'{vsix.get_cache_name()}.universal')
+
+def mark_universal(vsix, tmp_dir=None):
+    """
+    Record that the marketplace serves the universal package for ``vsix``'s
+    target, so later requests for that target use the plain VSIX name.
+    """
+    open(get_universal_marker_path(vsix, tmp_dir), 'w').close()
+
+def is_universal_vsix(path):
+    """Whether a cached VSIX is a universal package. Older versions cached platform packages under the plain name too."""
+    try:
+        return get_vsix_metadata(path)['target_platform'] is None
+    except (OSError, zipfile.BadZipFile, KeyError, json.JSONDecodeError, ElementTree.ParseError):
+        return False
+
+def read_vsix_manifest(path):
+    """
+    Read extension/package.json from a VSIX. ZipFile only parses the central
+    directory and inflates the requested member, the rest of the package is
+    never decompressed.
+    """
+    with zipfile.ZipFile(path) as vsix_file:
+        return json.loads(vsix_file.read('extension/package.json'))
+
+def read_vsix_identity(path):
+    """
+    Target platform and properties from the VSIX's extension.vsixmanifest.
+    Returns (target_platform or None, {property id: value}).
+    """
+    namespace = '{http://schemas.microsoft.com/developer/vsx-schema/2011}'
+    with zipfile.ZipFile(path) as vsix_file:
+        try:
+            root = ElementTree.fromstring(vsix_file.read('extension.vsixmanifest'))
+        except KeyError:
+            return None, {}
+    identity = root.find(f'{namespace}Metadata/{namespace}Identity')
+    properties = {
+        prop.get('Id'): prop.get('Value')
+        for prop in root.iter(f'{namespace}Property')
+    }
+    return (identity.get('TargetPlatform') if identity is not None else None), properties
+
+def get_vsix_metadata(path):
+    """
+    Metadata of a cached VSIX, stored next to it as ``<name>.meta.json`` so the
+    archive is opened at most once.
+    """
+    meta_path = f'{path}.meta.json'
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            metadata = json.load(f)
+        # Sidecars written before the vsixmanifest was read are refreshed
+        if 'target_platform' in metadata:
+            return metadata
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    manifest = read_vsix_manifest(path)
+    target_platform, properties = read_vsix_identity(path)
+    metadata = {
+        'manifest': manifest,
+        'engine': manifest.get('engines', {}).get('vscode'),
+        'size': os.path.getsize(path),
+        'target_platform': target_platform,
+        'properties': properties,
+    }
+    part_path = f'{meta_path}.{uuid.uuid4().hex}.part'
+    with open(part_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.replace(part_path, meta_path)
+    return metadata
+
+def get_local_manifest(publisher, extension, version, targets):
+    """
+    Manifest of an already downloaded VSIX for any of the given targets
+    (None meaning the universal package), or None if nothing is cached.
+    """
+    tmp_dir = get_tmp_dir()
+    # Universal packages are stored without a target, see download_vsix
+    for target in dict.fromkeys(list(targets) + [None]):
+        path = os.path.join(tmp_dir, VsixPackage(publisher, extension, version, target).get_cache_name())
+        if os.path.exists(path):
+            try:
+                return get_vsix_metadata(path)['manifest']
+            except (zipfile.BadZipFile, KeyError, json.JSONDecodeError):
+                continue
+    return None
+
 def create_download_id():
     return str(uuid.uuid4())
 
 def get_download_status(download_id):
-    return cache.get(f'download_status_{download_id}', {
+    state = DownloadJob.objects.filter(download_id=download_id).values_list('state', flat=True).first()
+    return state or {
         'status': 'not_found',
         'progress': 0,
         'current_file': '',
         'total_files': 0,
         'downloaded_files': 0,
         'details': []
-    })
+    }
 
-def set_download_status(download_id, status, progress=0, current_file='', total_files=0, downloaded_files=0, details=None):
-    current_status = get_download_status(download_id)
+def set_download_status(download_id, status, progress=0, current_file='', total_files=0, downloaded_files=0, details=None, extra=None):
+    with span('status.load'):
+        current_status = get_download_status(download_id)
     if details is not None:
         current_status['details'] = details
+    if extra:
+        current_status.update(extra)
     current_status.update({
         'status': status,
         'progress': progress,
@@ -438,7 +840,206 @@ def set_download_status(download_id, status, progress=0, current_file='', total_
         'total_files': total_files,
         'downloaded_files': downloaded_files
     })
-    cache.set(f'download_status_{download_id}', current_status, timeout=3600)  # Cache for 1 hour
+    # Stored in the database so every worker process can answer status polls
+    with span('status.save', status=status):
+        DownloadJob.objects.update_or_create(download_id=download_id, defaults={'state': current_status})
+
+def cleanup_download_jobs(max_age=BUNDLE_MAX_AGE):
+    """Forget jobs that have not been updated for ``max_age`` seconds, except bulk jobs waiting to be resumed"""
+    DownloadJob.objects.filter(
+        updated_at__lt=timezone.now() - timedelta(seconds=max_age)
+    ).exclude(
+        params__isnull=False, state__status__in=UNFINISHED_STATUSES
+    ).delete()
+
+def get_worker_id():
+    # Computed on use, gunicorn workers may share the imported module with their master
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def start_job_heartbeat(download_id):
+    """
+    Keep touching the job while it runs so other workers can tell it is alive.
+    Returns an Event that stops the heartbeat when set.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+                DownloadJob.objects.filter(download_id=download_id).update(updated_at=timezone.now())
+        finally:
+            connection.close()
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+class JobCancelled(Exception):
+    pass
+
+def make_cancel_check(download_id, interval=1.0):
+    """
+    Return a function that raises JobCancelled once the job was cancelled or
+    abandoned by its client. The database is asked at most every ``interval``
+    seconds, so it is cheap enough to call for every downloaded chunk.
+    """
+    last_check = [0.0]
+
+    def check_cancelled(*args):
+        now = time.monotonic()
+        if now - last_check[0] < interval:
+            return
+        last_check[0] = now
+        with span('status.cancel_check'):
+            job = DownloadJob.objects.filter(download_id=download_id).values('cancelled_at', 'last_polled_at', 'created_at').first()
+        if job is None or job['cancelled_at']:
+            raise JobCancelled('Cancelled')
+        last_seen = job['last_polled_at'] or job['created_at']
+        if timezone.now() - last_seen > timedelta(seconds=settings.VSCODE_DOWNLOADER_ABANDON_TIMEOUT):
+            DownloadJob.objects.filter(download_id=download_id).update(cancelled_at=timezone.now())
+            raise JobCancelled('Abandoned, nobody polled the status any more')
+
+    return check_cancelled
+
+def remove_bundle_files(download_id):
+    bundle_dir = get_bundle_dir()
+    for name in os.listdir(bundle_dir):
+        if name.startswith(f'{download_id}.') or name.startswith(f'{download_id}-'):
+            try:
+                os.remove(os.path.join(bundle_dir, name))
+            except FileNotFoundError:
+                pass
+
+def save_job_items(download_id, items):
+    with span('status.items'):
+        DownloadJob.objects.filter(download_id=download_id).update(items=items, updated_at=timezone.now())
+
+def run_bulk_job(download_id):
+    """Run (or resume) a persisted bulk job from its stored parameters"""
+    params = DownloadJob.objects.filter(download_id=download_id).values_list('params', flat=True).first()
+    if params:
+        params.pop('resume_attempts', None)
+        download_extensions_bulk_async(download_id, **params)
+
+def resume_unfinished_jobs():
+    """
+    Pick up bulk jobs whose worker died. A job is stale when its heartbeat is
+    older than JOB_LEASE; the conditional update makes sure only one worker
+    claims it. Resumes are counted in the job's params, after JOB_MAX_RESUMES
+    the job is failed instead so it can be cleaned up.
+    """
+    stale_jobs = DownloadJob.objects.filter(
+        params__isnull=False,
+        state__status__in=UNFINISHED_STATUSES,
+        updated_at__lt=timezone.now() - timedelta(seconds=JOB_LEASE),
+    ).values_list('pk', 'download_id', 'updated_at', 'params', 'state')
+    for pk, download_id, updated_at, params, state in stale_jobs:
+        attempts = params.get('resume_attempts', 0)
+        claimed = DownloadJob.objects.filter(pk=pk, updated_at=updated_at).update(
+            owner=get_worker_id(), updated_at=timezone.now(), params=dict(params, resume_attempts=attempts + 1)
+        )
+        if not claimed:
+            continue
+        if attempts >= JOB_MAX_RESUMES:
+            print(f'Giving up bulk download {download_id} after {attempts} resumes')
+            message = f'Error: Gave up after {attempts} interrupted attempts'
+            set_download_status(download_id, 'error', 0, message, state.get('total_files', 0),
+                                state.get('downloaded_files', 0), state.get('details', []) + [f'✗ {message}'])
+            continue
+        print(f'Resuming bulk download {download_id}')
+        threading.Thread(target=run_bulk_job, args=(download_id,)).start()
+
+_job_supervisor_pid = None
+_job_supervisor_lock = threading.Lock()
+
+def start_job_supervisor():
+    """Start the thread that resumes abandoned jobs, once per process"""
+    global _job_supervisor_pid
+    if not settings.VSCODE_DOWNLOADER_RESUME_JOBS:
+        return
+    with _job_supervisor_lock:
+        if _job_supervisor_pid == os.getpid():
+            return
+        _job_supervisor_pid = os.getpid()
+
+    def supervise():
+        # Give the server a moment to start before touching the database
+        time.sleep(5)
+        while True:
+            try:
+                resume_unfinished_jobs()
+            except Exception as e:
+                print(f'Error resuming download jobs: {str(e)}')
+            finally:
+                connection.close()
+            time.sleep(JOB_LEASE / 2)
+
+    threading.Thread(target=supervise, daemon=True).start()
+
+def get_bundle_dir():
+    bundle_dir = os.path.join(get_tmp_dir(), 'bundles')
+    os.makedirs(bundle_dir, exist_ok=True)
+    return bundle_dir
+
+def get_bundle_path(download_id, platform=None, volume=None, index=False):
+    name = f'{download_id}-{platform}' if platform else f'{download_id}'
+    if volume:
+        name = f'{name}.{int(volume):03d}.zip'
+    elif index:
+        name = f'{name}.index.json'
+    else:
+        name = f'{name}.zip'
+    # Both parts come from the URL, never let them escape the bundle directory
+    if os.path.basename(name) != name or name.startswith('.'):
+        raise ValueError(f'Invalid bundle name: {name}')
+    return os.path.join(get_bundle_dir(), name)
+
+def cleanup_bundles(max_age=BUNDLE_MAX_AGE):
+    """Remove finished bundles that are older than ``max_age`` seconds"""
+    bundle_dir = get_bundle_dir()
+    now = time.time()
+    for name in os.listdir(bundle_dir):
+        path = os.path.join(bundle_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def set_download_headers(response):
+    response["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response["Pragma"] = "no-cache"
+    response["Expires"] = "0"
+    response["X-Content-Type-Options"] = "nosniff"
+    response["Accept-Ranges"] = "bytes"
+    response["X-Download-Options"] = "noopen"
+    response["X-Permitted-Cross-Domain-Policies"] = "none"
+    # Add headers to make it look like a direct file download
+    response["Content-Transfer-Encoding"] = "binary"
+    response["Content-Description"] = "File Transfer"
+    return response
+
+def serve_file(path, filename, content_type='application/octet-stream'):
+    """
+    Return a file from the temp directory without reading it into Python.
+
+    By default this is a FileResponse, which the WSGI server sends with
+    os.sendfile via wsgi.file_wrapper. With SENDFILE_MODE set to
+    'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd) only headers
+    are returned and the front proxy streams the bytes itself.
+    """
+    mode = settings.VSCODE_DOWNLOADER_SENDFILE_MODE
+    if mode == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, get_tmp_dir()).replace(os.sep, '/')
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.VSCODE_DOWNLOADER_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative_path)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    else:
+        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=filename, content_type=content_type)
+    return set_download_headers(response)
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -447,51 +1048,145 @@ def api_start_bulk_download(request):
     try:
         data = json.loads(request.body)
         extensions = data.get('extensions', [])
+        # Several platforms can be bundled in one pass; extensions are then resolved server side
+        target_platforms = data.get('targetPlatforms') or []
+        vscode_version = data.get('vscodeVersion')
+        layout = data.get('layout', 'folders')
+        # Split the output into independent ZIP volumes for size limited transfer media
+        try:
+            volume_size = parse_size(data.get('volumeSize'))
+        except ValueError:
+            return JsonResponse({'error': f"Invalid volumeSize: {data.get('volumeSize')}"}, status=400)
+        # Record a trace of the job, see profiling.py
+        try:
+            profile = profile_mode(data.get('profile'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         
         if not extensions:
             return JsonResponse({'error': 'No extensions provided'}, status=400)
+        if target_platforms and not vscode_version:
+            return JsonResponse({'error': 'vscodeVersion is required when targetPlatforms is given'}, status=400)
+        if layout not in ('folders', 'archives'):
+            return JsonResponse({'error': f'Unknown layout: {layout}'}, status=400)
         
+        cleanup_bundles()
+        cleanup_traces(BUNDLE_MAX_AGE)
+        cleanup_download_jobs()
+        start_job_supervisor()
         download_id = create_download_id()
+        # The input is persisted so the job survives a restart of this worker
+        DownloadJob.objects.create(download_id=download_id, owner=get_worker_id(), params={
+            'extensions': extensions,
+            'target_platforms': target_platforms,
+            'vscode_version': vscode_version,
+            'layout': layout,
+            'volume_size': volume_size,
+            'profile': profile,
+        })
         set_download_status(download_id, 'starting', 0, '', len(extensions), 0, [])
         
         # Start download in background
-        threading.Thread(target=download_extensions_bulk_async, args=(download_id, extensions)).start()
+        threading.Thread(target=run_bulk_job, args=(download_id,)).start()
         
-        return JsonResponse({'download_id': download_id})
+        response_data = {'download_id': download_id}
+        if profile:
+            response_data['trace'] = reverse('vscode_downloader:api_download_trace', args=[download_id])
+        return JsonResponse(response_data)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
-def download_extensions_bulk_async(download_id, extensions):
-    """Download multiple extensions with detailed progress tracking"""
+def resolve_bundle_entries(extensions, vscode_version, target_platforms, details):
+    """
+    Resolve every extension once per platform and return a list of
+    (platform, VsixPackage) entries. Universal versions are returned without a
+    target so that they map to a single shared artifact.
+    """
+    entries = []
+    for extension_data in extensions:
+        extension_id = extension_data.get('id') or f"{extension_data['publisher']}.{extension_data['extension']}"
+        publisher, extension = extension_id.split('.', 1)
+        try:
+            with span('resolve', extension=extension_id):
+                resolved = resolve_extension_platforms(extension_id, vscode_version, target_platforms, use_cache=True)
+        except Exception as e:
+            details.append(f"✗ Failed to resolve {extension_id}: {str(e)}")
+            continue
+
+        for platform in target_platforms:
+            result = resolved.get(platform)
+            if not result:
+                details.append(f"✗ No compatible version of {extension_id} for {platform}")
+                continue
+            entries.append((platform, VsixPackage(
+                publisher=publisher,
+                extension=extension,
+                version=result['version'],
+                target=result.get('targetPlatform')
+            )))
+    return entries
+
+@background_traffic()
+def download_extensions_bulk_async(download_id, extensions, target_platforms=None, vscode_version=None, layout='folders',
+                                   volume_size=None, profile=None):
+    """
+    Download multiple extensions with detailed progress tracking.
+
+    Resolved entries are stored on the job with a per-item state, so a job
+    resumed after a restart skips resolution and only redoes the downloads
+    that are not in the cache yet, followed by packaging. With ``profile`` set
+    the job's trace is saved for api_download_trace.
+    """
+    total_files = len(extensions)
+    downloaded_files = 0
+    job = DownloadJob.objects.filter(download_id=download_id).only('state', 'items').first()
+    items = job.items if job else []
+    details = list(job.state.get('details', [])) if items else []
+    heartbeat = start_job_heartbeat(download_id)
+    check_cancelled = make_cancel_check(download_id)
+    trace = start_trace(download_id, profile)
     try:
-        total_files = len(extensions)
-        downloaded_files = 0
-        details = []
-        
+        check_cancelled()
         set_download_status(download_id, 'preparing', 0, '', total_files, downloaded_files, details)
         
-        # Create temp directory
-        tmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
-        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_dir = get_tmp_dir()
+
+        if items:
+            details.append("↻ Resuming download after a restart")
+        elif target_platforms:
+            set_download_status(download_id, 'resolving', 0, '', total_files, downloaded_files, details)
+            items = [
+                {'platform': platform, 'publisher': vsix.publisher, 'extension': vsix.extension,
+                 'version': vsix.version, 'target': vsix.target, 'state': 'pending'}
+                for platform, vsix in resolve_bundle_entries(extensions, vscode_version, target_platforms, details)
+            ]
+        else:
+            items = [
+                {'platform': None, 'publisher': extension_data['publisher'], 'extension': extension_data['extension'],
+                 'version': extension_data['version'], 'target': extension_data.get('targetPlatform'), 'state': 'pending'}
+                for extension_data in extensions
+            ]
+        save_job_items(download_id, items)
+        entries = [
+            (item['platform'], VsixPackage(
+                publisher=item['publisher'],
+                extension=item['extension'],
+                version=item['version'],
+                target=item['target']
+            ))
+            for item in items
+        ]
+
+        # Every artifact is downloaded once, even if several platforms share it
+        artifacts = {}
+        for _, vsix in entries:
+            artifacts.setdefault(vsix.get_cache_name(), vsix)
+        total_files = len(artifacts)
+        paths = {}
         
         # Download each extension
-        for i, extension_data in enumerate(extensions):
-            publisher = extension_data['publisher']
-            extension = extension_data['extension']
-            version = extension_data['version']
-            target_platform = extension_data.get('targetPlatform')
-            
-            vsix = VsixPackage(
-                publisher=publisher,
-                extension=extension,
-                version=version,
-                target=target_platform
-            )
-            
-            current_file = f"{publisher}.{extension}-{version}.vsix"
-            set_download_status(download_id, 'downloading', 
-                              int((i / total_files) * 50), 
-                              current_file, total_files, downloaded_files, details)
+        for i, vsix in enumerate(artifacts.values()):
+            current_file = vsix.get_vsix_name()
             
             # Add detail about current file
             details.append(f"Downloading {current_file}...")
@@ -500,83 +1195,118 @@ def download_extensions_bulk_async(download_id, extensions):
                               current_file, total_files, downloaded_files, details)
             
             # Download file
-            temp_path = os.path.join(tmp_dir, vsix.get_vsix_name())
-            
-            if not os.path.exists(temp_path):
-                try:
-                    response = requests.get(vsix.get_url(), stream=True)
-                    response.raise_for_status()
-                    
-                    with open(temp_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    
-                    details.append(f"✓ Downloaded {current_file}")
-                except Exception as e:
-                    details.append(f"✗ Failed to download {current_file}: {str(e)}")
-                    continue
-            else:
+            check_cancelled()
+            try:
+                with span('download', file=current_file):
+                    paths[vsix.get_cache_name()], cached = download_vsix(vsix, tmp_dir, on_progress=check_cancelled)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                details.append(f"✗ Failed to download {current_file}: {str(e)}")
+                continue
+            if cached:
                 details.append(f"✓ {current_file} already exists (cached)")
+            else:
+                details.append(f"✓ Downloaded {current_file}")
+            for item, (_, entry_vsix) in zip(items, entries):
+                if entry_vsix.get_cache_name() == vsix.get_cache_name():
+                    item['state'] = 'downloaded'
+            save_job_items(download_id, items)
             
             downloaded_files += 1
             set_download_status(download_id, 'downloading', 
                               int((downloaded_files / total_files) * 50), 
                               current_file, total_files, downloaded_files, details)
         
-        # Create zip file
+        # Create zip file(s)
         set_download_status(download_id, 'packaging', 50, 'Creating ZIP file...', total_files, downloaded_files, details)
         details.append("Creating ZIP file...")
-        
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for i, extension_data in enumerate(extensions):
-                publisher = extension_data['publisher']
-                extension = extension_data['extension']
-                version = extension_data['version']
-                target_platform = extension_data.get('targetPlatform')
-                
-                vsix = VsixPackage(
-                    publisher=publisher,
-                    extension=extension,
-                    version=version,
-                    target=target_platform
-                )
-                
-                temp_path = os.path.join(tmp_dir, vsix.get_vsix_name())
-                if os.path.exists(temp_path):
-                    zip_file.write(temp_path, arcname=vsix.get_vsix_name())
-                    details.append(f"✓ Added {vsix.get_vsix_name()} to ZIP")
+
+        if target_platforms and layout == 'archives':
+            archives = {platform: [] for platform in target_platforms}
+            for platform, vsix in entries:
+                archives[platform].append((vsix, vsix.get_vsix_name()))
+        else:
+            archives = {None: [
+                (vsix, f"{platform}/{vsix.get_vsix_name()}" if platform else vsix.get_vsix_name())
+                for platform, vsix in entries
+            ]}
+
+        total_entries = max(len(entries), 1)
+        packaged = 0
+        volumes = {}
+        for platform, archive_entries in archives.items():
+            # The finished bundle stays on disk and is served from there
+            bundle = BundleWriter(get_bundle_path(download_id, platform), volume_size)
+            for vsix, arcname in archive_entries:
+                packaged += 1
+                temp_path = paths.get(vsix.get_cache_name())
+                try:
+                    check_cancelled()
+                except JobCancelled:
+                    bundle.abort()
+                    raise
+                if temp_path and os.path.exists(temp_path):
+                    with span('zip.add', file=arcname):
+                        bundle.add(temp_path, arcname)
+                    details.append(f"✓ Added {arcname} to ZIP")
                     
                     # Update progress for packaging phase
-                    packaging_progress = 50 + int((i / total_files) * 50)
+                    packaging_progress = 50 + int((packaged / total_entries) * 50)
                     set_download_status(download_id, 'packaging', packaging_progress, 
-                                      f'Adding {vsix.get_vsix_name()} to ZIP...', 
+                                      f'Adding {arcname} to ZIP...', 
                                       total_files, downloaded_files, details)
-        
-        # Store the zip data in cache for retrieval
-        zip_buffer.seek(0)
-        zip_data = zip_buffer.getvalue()
-        cache.set(f'download_zip_{download_id}', zip_data, timeout=3600)
+            with span('zip.close', platform=platform):
+                bundle.close()
+            if volume_size:
+                volumes[platform or ''] = [volume['name'] for volume in bundle.volumes]
         
         details.append("✓ ZIP file created successfully")
-        set_download_status(download_id, 'completed', 100, 'Download complete!', total_files, downloaded_files, details)
+        extra = {}
+        if target_platforms:
+            extra['archives'] = [platform for platform in archives if platform]
+        if volume_size:
+            extra['volumes'] = volumes
+        set_download_status(download_id, 'completed', 100, 'Download complete!', total_files, downloaded_files, details, extra)
         
+    except JobCancelled as e:
+        details.append(f"✗ {str(e)}")
+        remove_bundle_files(download_id)
+        set_download_status(download_id, 'cancelled', 0, str(e), total_files, downloaded_files, details)
     except Exception as e:
         details.append(f"✗ Error: {str(e)}")
         set_download_status(download_id, 'error', 0, f'Error: {str(e)}', total_files, downloaded_files, details)
+    finally:
+        heartbeat.set()
+        finish_trace(trace)
+        # Background threads get their own database connection
+        connection.close()
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def api_download_extensions(request):
+    trace = None
     try:
         data = json.loads(request.body)
         extensions = data.get('extensions', [])
+        try:
+            profile = profile_mode(data.get('profile'))
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
 
         print(f'Downloading {len(extensions)} extensions')
 
-        zip_buffer = BytesIO()
+        # With a sendfile mode the bundles stay on disk for the proxy, and deployments
+        # that only use this endpoint never start a bulk job that would remove them
+        cleanup_bundles()
+        cleanup_traces(BUNDLE_MAX_AGE)
+        tmp_dir = get_tmp_dir()
+        download_id = create_download_id()
+        bundle_path = get_bundle_path(download_id)
+        # The trace is fetched afterwards with the id from the X-Download-Id header
+        trace = start_trace(download_id, profile)
             
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        with zipfile.ZipFile(bundle_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
             for extension_data in extensions:
                 # Get extension details to find compatible version
                 print(f'Getting extension details for {extension_data}')
@@ -593,78 +1323,113 @@ def api_download_extensions(request):
                 )
 
                 print(f'Downloading {vsix.get_vsix_name()}')
-                
-                # Create absolute path for temp directory
-                tmp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
-                os.makedirs(tmp_dir, exist_ok=True)
-                
-                # Use absolute path for temp file
-                temp_path = os.path.join(tmp_dir, vsix.get_vsix_name())
-
-                # Check if file exists in tmp directory
-                if not os.path.exists(temp_path):
-                    # Download if not exists
-                    response = requests.get(vsix.get_url())
-                    response.raise_for_status()
-                    
-                    # Save to tmp directory
-                    os.makedirs(tmp_dir, exist_ok=True)
-                    with open(temp_path, 'wb') as f:
-                        f.write(response.content)
-
+                with span('download', file=vsix.get_vsix_name()):
+                    temp_path, _ = download_vsix(vsix, tmp_dir)
 
                 print(f'Adding {vsix.get_vsix_name()} to zip file')
                 # Add to zip file using arcname to control the name in the zip
-                zip_file.write(temp_path, arcname=vsix.get_vsix_name())
+                with span('zip.add', file=vsix.get_vsix_name()):
+                    zip_file.write(temp_path, arcname=vsix.get_vsix_name())
         
-        zip_buffer.seek(0)
-        response = HttpResponse(zip_buffer.getvalue(), content_type='application/octet-stream')
-        response['Content-Disposition'] = 'attachment; filename="vscode_extensions.zip"'
-        response["Content-Length"] = str(len(zip_data))
-        response["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response["Pragma"] = "no-cache"
-        response["Expires"] = "0"
-        response["X-Content-Type-Options"] = "nosniff"
-        response["Accept-Ranges"] = "bytes"
-        response["X-Download-Options"] = "noopen"
-        response["X-Permitted-Cross-Domain-Policies"] = "none"
-        # Add headers to make it look like a direct file download
-        response["Content-Transfer-Encoding"] = "binary"
-        response["Content-Description"] = "File Transfer"
+        response = serve_file(bundle_path, 'vscode_extensions.zip')
+        if not settings.VSCODE_DOWNLOADER_SENDFILE_MODE:
+            # FileResponse holds the open file, so the name can go right away
+            os.remove(bundle_path)
+        if trace:
+            response['X-Download-Id'] = download_id
         return response
         
     except Exception as e:
         print(f'Error downloading extensions: {str(e)}')
         return HttpResponse(str(e), status=500)
+    finally:
+        finish_trace(trace)
+
+def api_download_trace(request, download_id):
+    """
+    The profiling trace of a job started with "profile". ``?format=`` selects
+    'json' (Trace Event format), 'folded' (span self times in microseconds) or
+    'samples' (sampled stacks, jobs profiled in 'sample' mode only); both
+    folded formats are flamegraph.pl/speedscope input.
+    """
+    output_format = request.GET.get('format', 'json')
+    if output_format not in ('json', 'folded', 'samples'):
+        return JsonResponse({'error': f'Unknown format: {output_format}'}, status=400)
+    try:
+        trace = load_trace(download_id)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if trace is None:
+        return JsonResponse({'error': 'No trace for this download, it was not profiled or has not finished yet'}, status=404)
+
+    if output_format == 'json':
+        trace.pop('stacks')
+        trace.pop('samples')
+        return compressed_json_response(request, trace)
+    stacks = trace['stacks'] if output_format == 'folded' else trace['samples']
+    if not stacks:
+        return JsonResponse({'error': 'This download was not profiled with stack sampling'}, status=404)
+    return HttpResponse(fold(stacks), content_type='text/plain; charset=utf-8')
 
 def api_get_bulk_download_zip(request, download_id):
     """Get the completed ZIP file for a bulk download"""
     try:
-        zip_data = cache.get(f'download_zip_{download_id}')
-        if not zip_data:
+        # Jobs using the 'archives' layout produce one ZIP per platform
+        platform = request.GET.get('platform')
+        # Jobs started with a volumeSize are fetched volume by volume (?volume=1, 2, ...) plus ?index=1
+        volume = request.GET.get('volume')
+        index = bool(request.GET.get('index'))
+        try:
+            bundle_path = get_bundle_path(download_id, platform, volume, index)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if not os.path.exists(bundle_path):
             return JsonResponse({'error': 'ZIP file not found or expired'}, status=404)
         
-        response = HttpResponse(zip_data, content_type='application/octet-stream')
-        response['Content-Disposition'] = 'attachment; filename="vscode_extensions.zip"'
-        response["Content-Length"] = str(len(zip_data))
-        response["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response["Pragma"] = "no-cache"
-        response["Expires"] = "0"
-        response["X-Content-Type-Options"] = "nosniff"
-        response["Accept-Ranges"] = "bytes"
-        response["X-Download-Options"] = "noopen"
-        response["X-Permitted-Cross-Domain-Policies"] = "none"
-        # Add headers to make it look like a direct file download
-        response["Content-Transfer-Encoding"] = "binary"
-        response["Content-Description"] = "File Transfer"
-        return response
+        filename = f'vscode_extensions-{platform}' if platform else 'vscode_extensions'
+        if volume:
+            return serve_file(bundle_path, f'{filename}.{int(volume):03d}.zip')
+        if index:
+            return serve_file(bundle_path, f'{filename}.index.json', 'application/json')
+        return serve_file(bundle_path, f'{filename}.zip')
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+def api_get_vsix(request, extension_id, version):
+    """Serve a single VSIX from the local cache, downloading it first if needed"""
+    try:
+        target_platform = request.GET.get('targetPlatform') or request.GET.get('target_platform')
+        publisher, extension = extension_id.split('.', 1)
+        vsix = VsixPackage(
+            publisher=publisher,
+            extension=extension,
+            version=version,
+            target=target_platform
+        )
+        temp_path, _ = download_vsix(vsix)
+        return serve_file(temp_path, vsix.get_vsix_name())
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 def api_download_status(request, download_id):
+    # Also covers servers that import the app before forking their workers
+    start_job_supervisor()
+    # Polling keeps the job alive, see make_cancel_check
+    DownloadJob.objects.filter(download_id=download_id).update(last_polled_at=timezone.now())
     status = get_download_status(download_id)
     return JsonResponse(status)
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_cancel_download(request, download_id):
+    """Ask a running download to stop, it does so at its next cancellation check"""
+    cancelled = DownloadJob.objects.filter(
+        download_id=download_id, cancelled_at__isnull=True, state__status__in=UNFINISHED_STATUSES
+    ).update(cancelled_at=timezone.now())
+    if not cancelled and not DownloadJob.objects.filter(download_id=download_id).exists():
+        return JsonResponse({'error': 'Download not found'}, status=404)
+    return JsonResponse({'download_id': download_id, 'cancelled': bool(cancelled)})
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def api_start_extension_download(request, extension_id):
@@ -699,41 +1464,29 @@ def download_extension_async(download_id, extension_id, version, target_platform
         )
         
         set_download_status(download_id, 'downloading', 0)
-        response = requests.get(vsix.get_url(), stream=True)
-        response.raise_for_status()
-        
-        # Get total file size
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 8192
-        downloaded = 0
-
-        # Create tmp directory if it doesn't exist
-        os.makedirs('./tmp', exist_ok=True)
-        # Store the downloaded file temporarily
-        temp_path = f'./tmp/{vsix.get_vsix_name()}'
-
-        # Check if file already exists
-        if os.path.exists(temp_path):
-            set_download_status(download_id, 'completed', 100)
-            return
-
-        with open(temp_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=block_size):
-                downloaded += len(chunk)
-                f.write(chunk)
-                
-                # Calculate and update progress
-                if total_size > 0:  # Avoid division by zero
-                    progress = int((downloaded / total_size) * 100)
+        last_update = {'progress': 0, 'time': time.monotonic()}
+
+        def on_progress(downloaded, total_size):
+            # Calculate and update progress
+            if total_size > 0:  # Avoid division by zero
+                progress = int((downloaded / total_size) * 100)
+                now = time.monotonic()
+                # Every status write takes SQLite's write lock, so only write whole percent
+                # changes and at most every PROGRESS_INTERVAL seconds
+                if progress != last_update['progress'] and now - last_update['time'] >= PROGRESS_INTERVAL:
                     set_download_status(download_id, 'downloading', progress)
-        
+                    last_update.update(progress=progress, time=now)
+
+        # Stores into the same cache the bundles and api_get_vsix read from
+        download_vsix(vsix, on_progress=on_progress)
         set_download_status(download_id, 'completed', 100)
         
     except Exception as e:
         set_download_status(download_id, 'error', 0)
         # Optionally log the error
         print(f"Download error for {extension_id}: {str(e)}")
-
+    finally:
+        connection.close()
 
 def landing_page(request):
     """Landing page view that displays available applications"""